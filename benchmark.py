@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"Measure the performance of odt2wiki's stages on a given input."
+
+from argparse import ArgumentParser
+from zipfile import ZipFile
+import contextlib
+import io
+import os.path
+import time
+import tracemalloc
+
+import odt_tools
+import odt_parser
+import document
+import md_writer
+import image_matcher
+
+
+TEXT_XML_FILE_NAME = "content.xml"
+STYLES_XML_FILE_NAME = "styles.xml"
+
+
+def _measure(method, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = method()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def _print_row(name, *columns):
+    print(f"{name:<24}" + "".join([f"{c:>12}" for c in columns]))
+
+
+# Compare XML backends on parsing and traversing the document
+def benchmark_parsers(archive, repeat):
+    content = archive.read(TEXT_XML_FILE_NAME)
+    styles = odt_tools.parse(archive.read(STYLES_XML_FILE_NAME))
+    parsers = ["stdlib",]
+    if odt_tools.has_lxml:
+        parsers.append("lxml")
+    else:
+        print("lxml is not installed - measuring the standard library only")
+    print(f"{TEXT_XML_FILE_NAME}: {len(content) / 1024 / 1024:.1f} MB, best of {repeat} runs")
+    print()
+    _print_row("Backend", "parse, s", "traverse, s", "total, s", "stream, s")
+    for p in parsers:
+        odt_tools.set_parser(p)
+        parse_time, root = _measure(lambda: odt_tools.parse(content), repeat)
+        def traverse():
+            visitor = odt_parser.FullVisitor()
+            visitor.preload_styles(styles)
+            visitor.traverse(root)
+        traverse_time, _ = _measure(traverse, repeat)
+        def stream():
+            visitor = odt_parser.FullVisitor()
+            visitor.preload_styles(styles)
+            with archive.open(TEXT_XML_FILE_NAME) as source:
+                visitor.stream(source)
+        stream_time, _ = _measure(stream, repeat)
+        _print_row(p, f"{parse_time:.3f}", f"{traverse_time:.3f}", f"{parse_time + traverse_time:.3f}", f"{stream_time:.3f}")
+    odt_tools.set_parser("auto")
+
+
+def _measure_memory(method):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = method()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+def _count_spans(content):
+    num_spans = 0
+    num_paragraphs = 0
+    for c in content:
+        match c:
+            case document.Paragraph():
+                num_paragraphs += 1
+                num_spans += len(c.spans)
+            case document.List():
+                spans, paragraphs = _count_spans(c.items)
+                num_spans += spans
+                num_paragraphs += paragraphs
+            case document.Table():
+                for r in c.rows:
+                    spans, paragraphs = _count_spans([cell for cell in r if cell])
+                    num_spans += spans
+                    num_paragraphs += paragraphs
+    return num_spans, num_paragraphs
+
+
+# Measure the memory taken by the document model
+def benchmark_memory(archive, count):
+    text = "text"
+    style = document.Style()
+    print(f"Memory per object, average of {count} objects:")
+    size, _ = _measure_memory(lambda: [document.Span(text, style) for _ in range(count)])
+    print(f"Span:                       {size / count:.0f} bytes")
+    def make_paragraphs():
+        output = []
+        for _ in range(count):
+            paragraph = document.Paragraph()
+            paragraph.spans.append(document.Span(text, style))
+            output.append(paragraph)
+        return output
+    size, _ = _measure_memory(make_paragraphs)
+    print(f"Paragraph with one Span:    {size / count:.0f} bytes")
+    # The whole document, including texts and styles
+    size, visitor = _measure_memory(lambda: _parse(archive))
+    num_spans, num_paragraphs = _count_spans(visitor._content)
+    print()
+    print(f"Parsed document: {size / 1024 / 1024:.1f} MB for {num_paragraphs} paragraphs with {num_spans} spans")
+    print(f"Per span:                   {size / num_spans:.0f} bytes")
+    print(f"Per paragraph:              {size / num_paragraphs:.0f} bytes")
+
+
+def _parse(archive):
+    visitor = odt_parser.FullVisitor()
+    visitor.preload_styles(odt_tools.parse(archive.read(STYLES_XML_FILE_NAME)))
+    with archive.open(TEXT_XML_FILE_NAME) as source:
+        visitor.stream(source)
+    return visitor
+
+def _collect_texts(content, output):
+    for c in content:
+        match c:
+            case document.Paragraph():
+                output.extend([s.text for s in c.spans])
+            case document.List():
+                _collect_texts(c.items, output)
+            case document.Table():
+                for r in c.rows:
+                    _collect_texts([cell for cell in r if cell], output)
+
+# The straightforward implementation to compare with
+def _escape_by_character(text):
+    output = []
+    for l in text:
+        if l in md_writer.SPECIAL_CHARACTERS:
+            output.append("\\")
+        output.append(l)
+    return "".join(output)
+
+
+# Compare markdown escaping on the texts of the document
+def benchmark_escaping(archive, repeat):
+    texts = []
+    _collect_texts(_parse(archive)._content, texts)
+    escape = md_writer.MarkdownWriter._escape_text
+    assert [escape(t) for t in texts] == [_escape_by_character(t) for t in texts]
+    num_special = sum([1 for t in texts if escape(t) != t])
+    print(f"{len(texts)} spans, {sum([len(t) for t in texts]) / 1024 / 1024:.1f} M characters, {num_special} spans to escape, best of {repeat} runs")
+    print()
+    _print_row("Method", "time, s")
+    by_character_time, _ = _measure(lambda: [_escape_by_character(t) for t in texts], repeat)
+    _print_row("by character", f"{by_character_time:.3f}")
+    writer_time, _ = _measure(lambda: [escape(t) for t in texts], repeat)
+    _print_row("MarkdownWriter", f"{writer_time:.3f}")
+
+
+# The straightforward implementation to compare with
+def _calc_stats_by_bin(image):
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    numpixels = image.width * image.height
+    histogram = image.histogram()
+    return [sum([histogram[c * 256 + i] * i for i in range(256)]) / numpixels for c in range(3)]
+
+
+# Measure the stages of calculating image statistics on the pictures inside the document
+def benchmark_images(archive, repeat):
+    if not image_matcher.has_image_matcher:
+        print("Image matching requires Pillow to be installed")
+        return
+    names = [n for n in archive.namelist() if n.startswith(image_matcher.PICTURES_FOLDER)]
+    if not names:
+        print("There are no pictures in the document")
+        return
+    data = [archive.read(n) for n in names]
+    images = []
+    for d in data:
+        with io.BytesIO(d) as source:
+            images.append(image_matcher._load_image(source)[0])
+    for i in images:
+        stats = image_matcher._calc_stats(i)
+        assert [stats.r, stats.g, stats.b] == _calc_stats_by_bin(i)
+    print(f"{len(images)} pictures, {sum([i.width * i.height for i in images]) / 1000000:.1f} M pixels, best of {repeat} runs")
+    print()
+    _print_row("Stage", "time, s")
+    def load():
+        for d in data:
+            with io.BytesIO(d) as source:
+                image_matcher._load_image(source)
+    _print_row("decode", f"{_measure(load, repeat)[0]:.3f}")
+    _print_row("histogram only", f"{_measure(lambda: [i.histogram() for i in images], repeat)[0]:.3f}")
+    # Both include calculating the histograms
+    _print_row("stats by bin, RGBA", f"{_measure(lambda: [_calc_stats_by_bin(i) for i in images], repeat)[0]:.3f}")
+    _print_row("stats", f"{_measure(lambda: [image_matcher._calc_stats(i) for i in images], repeat)[0]:.3f}")
+    _print_row("perceptual hash", f"{_measure(lambda: [image_matcher._calc_dhash(i) for i in images], repeat)[0]:.3f}")
+
+
+# Compare matching images after decoding them at the full and at a reduced resolution
+def benchmark_matching(archive, image_folder, repeat):
+    if not image_matcher.has_image_matcher:
+        print("Image matching requires Pillow to be installed")
+        return
+    image_folder = os.path.expanduser(image_folder)
+    print(f"Matching the document's pictures to {image_folder}, best of {repeat} runs")
+    print()
+    _print_row("Decoding", "time, s", "matched")
+    results = {}
+    for reduced in (False, True):
+        def match():
+            with contextlib.redirect_stdout(io.StringIO()):
+                try:
+                    matched, _, _ = image_matcher.match_images(archive, image_folder, None, 1, reduced)
+                except AssertionError:
+                    return None     # Ambiguous images
+            return {k: v.link for k, v in matched.items()}
+        elapsed, results[reduced] = _measure(match, repeat)
+        _print_row("reduced" if reduced else "full", f"{elapsed:.3f}", "ambiguous" if results[reduced] is None else len(results[reduced]))
+    print()
+    if None in results.values():
+        print("Cannot compare the matches as some images are ambiguous")
+        return
+    full, reduced = results[False], results[True]
+    changed = [k for k in sorted(full.keys() | reduced.keys()) if full.get(k) != reduced.get(k)]
+    print(f"Matches changed by reduced decoding: {len(changed)}")
+    for k in changed:
+        print(f"{k}: {full.get(k)} -> {reduced.get(k)}")
+
+
+def main():
+    description = "Benchmark odt2wiki on a (preferably large) ODT file."
+    usage = """
+benchmark.py <input.odt> --parse [--repeat=<count>]
+benchmark.py <input.odt> --memory [--count=<count>]
+benchmark.py <input.odt> --escape [--repeat=<count>]
+benchmark.py <input.odt> --images [--repeat=<count>]
+benchmark.py <input.odt> --match=<images_folder> [--repeat=<count>]"""
+
+    # Set up the CLI arguments
+    parser = ArgumentParser(description=description, usage=usage)
+
+    parser.add_argument("input", help="input ODT file")
+
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-p", "--parse", action="store_true", help="compare XML backends on parsing and traversing the document")
+    group.add_argument("-m", "--memory", action="store_true", help="measure memory used by the document model")
+    group.add_argument("-e", "--escape", action="store_true", help="compare markdown escaping methods on the document's text")
+    group.add_argument("-i", "--images", action="store_true", help="measure calculating statistics for the document's pictures")
+    group.add_argument("-t", "--match", action="store", metavar="FOLDER", help="compare matching the document's pictures to a local folder at the full and at a reduced resolution")
+
+    parser.add_argument("-n", "--repeat", action="store", type=int, default=3, help="run each measurement this many times and keep the best result")
+    parser.add_argument("-c", "--count", action="store", type=int, default=100000, help="number of objects to create for memory measurements")
+
+    args = parser.parse_args()
+    assert args.repeat > 0
+    assert args.count > 0
+
+    print()
+    print(f"Benchmarking {args.input} ...")
+    with ZipFile(os.path.expanduser(args.input)) as archive:
+        if args.parse:
+            benchmark_parsers(archive, args.repeat)
+        elif args.memory:
+            benchmark_memory(archive, args.count)
+        elif args.escape:
+            benchmark_escaping(archive, args.repeat)
+        elif args.images:
+            benchmark_images(archive, args.repeat)
+        elif args.match:
+            benchmark_matching(archive, args.match, args.repeat)
+        else:
+            assert False
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"On-disk cache for results of expensive processing stages"
+
+import hashlib
+import os
+import pickle
+
+
+DEFAULT_FOLDER = os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"), "odt2wiki")
+CHUNK_SIZE = 1024 * 1024
+
+
+def _hash():
+    return hashlib.blake2b(digest_size=20)
+
+# Hash the content of files inside a ZIP (ODT) archive
+def hash_members(archive, *names):
+    h = _hash()
+    for n in names:
+        with archive.open(n) as source:
+            while chunk := source.read(CHUNK_SIZE):
+                h.update(chunk)
+    return h.hexdigest()
+
+# Hash the source code of Python modules to invalidate cached data when the code changes
+def hash_modules(*modules):
+    h = _hash()
+    for m in modules:
+        with open(m.__file__, "rb") as source:
+            h.update(source.read())
+    return h.hexdigest()
+
+# Hash the content of a file which was read into memory, the same as hash_members() for a member with that content
+def hash_bytes(data):
+    h = _hash()
+    h.update(data)
+    return h.hexdigest()
+
+# Hash a string, e.g. a path to the input file
+def hash_string(string):
+    h = _hash()
+    h.update(string.encode("utf-8"))
+    return h.hexdigest()
+
+
+# A single pickled object stored along with the key it was built for.
+# Storing an object for a new key overwrites the old one, thus the cache does not grow over time.
+class Cache:
+    def __init__(self, folder, name):
+        self._folder = os.path.expanduser(folder)
+        self._filename = os.path.join(self._folder, name + ".pickle")
+
+    def load(self, key):
+        try:
+            with open(self._filename, "rb") as file:
+                if pickle.load(file) != key:
+                    return None
+                return pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring broken cache file {self._filename}: {e}")
+            return None
+
+    def store(self, key, data):
+        os.makedirs(self._folder, exist_ok=True)
+        temp_filename = self._filename + ".tmp"
+        with open(temp_filename, "wb") as file:
+            pickle.dump(key, file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, self._filename)
+
+
+# Results named by the hash of everything that was used to produce them.
+# Results which were not requested since the last prune() are dropped by it.
+class _ResultCache:
+    def __init__(self, version):
+        self.hits = 0
+        self.misses = 0
+        self._version = version.encode("utf-8")
+        self._used = set()
+    
+    def make_key(self, data):
+        h = _hash()
+        h.update(self._version)
+        h.update(data)
+        return h.hexdigest()
+    
+    def load(self, key):
+        self._used.add(key)
+        data = self._read(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+    
+    def store(self, key, data):
+        assert key in self._used
+        self._write(key, data)
+    
+    def prune(self):
+        self._drop_unused()
+        self._used = set()
+        self.hits = 0
+        self.misses = 0
+
+
+# Results stored as files in a folder
+class FileCache(_ResultCache):
+    def __init__(self, folder, name, version):
+        super().__init__(version)
+        self._folder = os.path.join(os.path.expanduser(folder), name)
+        os.makedirs(self._folder, exist_ok=True)
+    
+    def _read(self, key):
+        try:
+            with open(os.path.join(self._folder, key), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+    
+    def _write(self, key, data):
+        filename = os.path.join(self._folder, key)
+        with open(filename + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(filename + ".tmp", filename)
+    
+    def _drop_unused(self):
+        for f in os.listdir(self._folder):
+            if f not in self._used:
+                os.remove(os.path.join(self._folder, f))
+
+
+# Results kept in memory for the lifetime of the process
+class MemoryCache(_ResultCache):
+    def __init__(self, version):
+        super().__init__(version)
+        self._data = {}
+    
+    def _read(self, key):
+        return self._data.get(key)
+    
+    def _write(self, key, data):
+        self._data[key] = data
+    
+    def _drop_unused(self):
+        self._data = {k: v for k, v in self._data.items() if k in self._used}
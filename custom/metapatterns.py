@@ -148,6 +148,10 @@ class MetapatternsCustomization(plugins.Customization):
         assert not self._extra_images
         self._extra_images = {k: images[v] for k, v in toc_images.items() if v in images}
     
+    def get_render_signature(self):
+        images = sorted([(k, v.link, v.original, v.width, v.height) for k, v in self._extra_images.items()]) if self._extra_images else None
+        return self._hugo, images
+    
     def preprocess(self, section):
         title = section.header.to_string()
         # Strip technical terms "Part N" or "Appendix X" with the associated full stops
@@ -1,12 +1,20 @@
 "Internal representation of a book as a tree of sections (parts, chapters, etc.)"
 
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from enum import Enum, IntEnum, auto
+from itertools import accumulate
 from typing import Optional
-import copy
+import contextlib
+import io
+import multiprocessing
 import os
+import pickle
+import sys
 
 import plugins
+from output_folder import OutputFolder
 
 
 DEFAULT_NAME = "Introduction"
@@ -30,6 +38,8 @@ class ListStyle(Enum):
     
 
 class ImageData:
+    __slots__ = ("original", "link", "width", "height", "short_name")
+    
     def __init__(self, link, width=0, height=0, short_name = None):
         assert link
         self.original = self.link = link
@@ -70,6 +80,8 @@ class Style:
 
 # A chunk of text in a given style
 class Span:
+    __slots__ = ("text", "style", "link")
+    
     def __init__(self, text: str, style: Style = Style(), link: Optional[str] = None):
         self.text = text
         self.style = style
@@ -77,6 +89,8 @@ class Span:
 
 
 class TocItem:
+    __slots__ = ("name", "link", "level")
+    
     def __init__(self, name: str, link: str, level: int):
         self.name = name
         self.link = link
@@ -84,6 +98,8 @@ class TocItem:
 
 
 class NavItem:
+    __slots__ = ("name", "link")
+    
     def __init__(self, name, link):
         self.name = name
         self.link = link
@@ -93,10 +109,12 @@ class NavItem:
 
 
 class Content:
-    pass
+    __slots__ = ()
 
 
 class Paragraph(Content):
+    __slots__ = ("spans", "bookmarks", "grayed_out", "centered")
+    
     def __init__(self, text = None, link = None):
         self.spans = []
         self.bookmarks = []
@@ -111,6 +129,8 @@ class Paragraph(Content):
     def split(self, separator):
         assert not self.bookmarks
         text = self.to_string()
+        # Offsets of the spans in the text, chunks are found among them with a binary search
+        offsets = list(accumulate([len(s.text) for s in self.spans], initial=0))
         sep_length = len(separator)
         assert sep_length
         chunks = text.split(separator)
@@ -120,33 +140,33 @@ class Paragraph(Content):
             length = len(c)
             if length:
                 par = Paragraph()
-                par.spans = self._slice(index, index + length)
+                par.spans = self._slice(offsets, index, index + length)
                 par.grayed_out = self.grayed_out
                 output.append(par)
             index += (length + sep_length)
         assert index == len(text) + sep_length
         return output
         
-    def _slice(self, start, end):
+    def _slice(self, offsets, start, end):
         assert start < end
-        first = 0
+        spans = self.spans
         output = []
-        for s in self.spans:
-            span_length = len(s.text)
-            last = first + span_length
-            if last > start:
-                new_span = copy.copy(s)
-                new_span.text = new_span.text[max(start - first, 0) : min(end - first, span_length)]
-                assert len(new_span.text)
-                output.append(new_span)
-            first = last
-            if first >= end:
-                break
+        # Start from the span containing the first character
+        i = bisect_right(offsets, start) - 1
+        while i < len(spans) and offsets[i] < end:
+            s = spans[i]
+            first = offsets[i]
+            text = s.text[max(start - first, 0) : min(end, offsets[i + 1]) - first]
+            assert len(text)
+            output.append(Span(text, s.style, s.link))
+            i += 1
         assert len(output)
         return output
 
   
 class Header(Paragraph):
+    __slots__ = ("outline_level",)
+    
     def __init__(self, text = None):
         super(Header, self).__init__()
         self.outline_level = 0
@@ -155,17 +175,23 @@ class Header(Paragraph):
 
    
 class List(Content):
+    __slots__ = ("kind", "items")
+    
     def __init__(self):
         self.kind = None
         self.items = []
 
 
 class DefinitionList(Content):
+    __slots__ = ("items",)
+    
     def __init__(self):
         self.items = []
         
 
 class Table(Content):
+    __slots__ = ("num_columns", "rows")
+    
     def __init__(self):
         self.num_columns = 0
         self.rows = []
@@ -175,6 +201,8 @@ class Table(Content):
 
 
 class Image(Content):
+    __slots__ = ("data", "scale", "caption")
+    
     def __init__(self, link, scale):
         self.data = ImageData(link)
         self.scale = scale
@@ -186,6 +214,8 @@ class Image(Content):
         
 
 class ToC(Content):
+    __slots__ = ("items", "root")
+    
     def __init__(self):
         self.items = []
         self.root = None
@@ -195,6 +225,8 @@ class ToC(Content):
         
 
 class NavBar(Content):
+    __slots__ = ("prev", "next", "up")
+    
     def __init__(self):
         self.prev = None
         self.next = None
@@ -227,12 +259,17 @@ class TocMaker(plugins.Analytics):
 class Section:
     strategy = None
     split_level = None
+    output = None
+    
+    __slots__ = ("parent", "next", "prev", "header", "content", "children", "rel_filename", "abs_filename", "path_to_root", "type",
+                 "position", "prev_file", "next_file", "_bookmarked", "_linked")
     
     @classmethod
-    def set_strategy(cls, strategy, customization, split_level):
+    def set_strategy(cls, strategy, customization, split_level, output):
         cls.strategy = strategy
         cls.customization = customization
         cls.split_level = split_level
+        cls.output = output
         
     def __init__(self, parent, header):
         self.parent = parent
@@ -245,11 +282,18 @@ class Section:
         self.abs_filename = None
         self.path_to_root = ""
         self.type = SectionType.NONE
+        # Filled in by Document once the files are known
+        self.position = 0       # index among the parent's children
+        self.prev_file = None   # neighbouring pages for navigation
+        self.next_file = None
+        # Elements which take part in crosslinking
+        self._bookmarked = []   # (paragraph, is top-level)
+        self._linked = []       # spans with links
         
     @staticmethod
-    def create(name, content = [], abs_path = None):
+    def create(name, content = None, abs_path = None):
         output = Section(None, Header(name))
-        output.content = content
+        output.content = content if content is not None else []
         if abs_path:
             output.rel_filename = name + output.strategy.file_extension
             output.abs_filename = output._join_paths(abs_path, output.rel_filename)
@@ -273,7 +317,7 @@ class Section:
         if not self.header.outline_level:
             assert not root_to_parent
             if abs_root:
-                os.mkdir(abs_root)
+                self.output.make_dir(abs_root)
             self.rel_filename = self.strategy.index_filename(filename) + self.strategy.file_extension
             self.type = SectionType.FOLDER if self.split_level else SectionType.FILE
         # Create top-level folders
@@ -320,8 +364,15 @@ class Section:
         for child in self.children:
             child.match_images(external_images, internal_images)
     
+    def collect_sections(self, output):
+        output.append(self)
+        for child in self.children:
+            child.collect_sections(output)
+    
+    # The crosslinking methods below process a single section, its children are not visited
     def collect_bookmarks(self, direct, reverse, reverse_duplicates, remap):
         assert self.type != SectionType.NONE
+        self._build_index()
         # Extract bookmark from the header
         if self.header.bookmarks:
             self._process_bookmarks(self.header.bookmarks, 
@@ -334,49 +385,81 @@ class Section:
         else:
             assert not self.parent or self.header.spans[0].text == DEFAULT_NAME, self.header.to_string()
         # Extract bookmarks from the section's text
-        for c in self.content:
-            if isinstance(c, Paragraph) and c.bookmarks:
+        for c, is_top_level in self._bookmarked:
+            if is_top_level:
                 self._process_bookmarks(c.bookmarks, 
                                         c.to_string(), 
                                         remap, 
                                         reverse, 
                                         reverse_duplicates, 
                                         self.strategy.make_ref_for_text)
-        # Traverse children
-        for child in self.children:
-            child.collect_bookmarks(direct, reverse, reverse_duplicates, remap)
     
     def replace_bookmarks(self, direct, remap):
         if self.header.bookmarks:
             self.header.bookmarks = [self._replace_single_bookmark(self.header.bookmarks, direct),]
         else:
             assert not self.parent or self.header.spans[0].text == DEFAULT_NAME, self.header.to_string()
-        for c in self.content:
-            self._replace_bookmarks_in_content(c, remap)
-        for child in self.children:
-            child.replace_bookmarks(direct, remap)
+        for c, _ in self._bookmarked:
+            c.bookmarks = [self._replace_single_bookmark(c.bookmarks, remap),]
             
     def replace_links(self, mapping, broken):
         for s in self.header.spans:
             if s.link:
                 s.link = self._replace_single_link(s.link, mapping, broken)
-        for c in self.content:
-            self._replace_links_in_content(c, mapping, broken)
-        for child in self.children:
-            child.replace_links(mapping, broken)
+        for s in self._linked:
+            s.link = self._replace_single_link(s.link, mapping, broken)
         
-    def dump(self, writer_factory, writer = None):
+    # Write the file of this section and the files of its descendants
+    def dump(self, writer_factory, renders = None, jobs = 1):
         assert self.abs_filename
+        assert self.has_file()
+        pages = []
+        self._collect_pages(pages)
+        # Reuse the pages from a previous run if nothing they depend on has changed
+        keys = {}
+        to_render = []
+        for p in pages:
+            if renders:
+                key = keys[p] = renders.make_key(p._make_render_signature(writer_factory))
+                cached = renders.load(key)
+                if cached is not None:
+                    self.output.write_text(p.abs_filename, cached.decode("utf-8"))
+                    continue
+            to_render.append(p)
+        # Render the rest
+        if renders or jobs > 1:
+            # The cache and the worker processes need the whole text of a page
+            for p, text in zip(to_render, self._render_pages(to_render, writer_factory, jobs)):
+                self.output.write_text(p.abs_filename, text)
+                if renders:
+                    renders.store(keys[p], text.encode("utf-8"))
+        else:
+            # Write the pages into their files as they are rendered
+            for p in to_render:
+                with self.output.open_text(p.abs_filename) as file:
+                    p.render(writer_factory, file)
+    
+    # Render the file of this section, which includes the subsections without their own files.
+    # Returns the text unless it was written into the stream.
+    def render(self, writer_factory, stream = None):
+        assert self.has_file()
+        writer = writer_factory(self, max(self.header.outline_level, self.split_level), stream)
+        self._render(writer)
+        assert (not self.prev) == (not self.next)
+        if self.next and self.split_level and self.strategy.needs_navigation:   # No navbar for stand-alone ToC or a single-file project
+            writer.add(self._make_navigation())
+        writer.finish()
+        return None if stream else writer.get_output()
+    
+    def _render(self, writer):
         assert self.type != SectionType.NONE
-        # Start a new file if this is a book chapter or part
-        if self.has_file():
-            writer = writer_factory(self, max(self.header.outline_level, self.split_level))
         # Write our content
         writer.add_header(self.header)
         for c in self.content:
             writer.add(c)
         for child in self.children:
-            child.dump(writer_factory, writer)
+            if not child.has_file():
+                child._render(writer)
         # Optionally add a ToC with links to our child sections
         if self.header.outline_level and self.type == SectionType.FOLDER and self.customization.needs_local_toc(self):
             print(f"Added a ToC to '{self.header.to_string()}'")
@@ -384,13 +467,25 @@ class Section:
             toc_header.outline_level = max(self.header.outline_level, self.split_level) + 1
             writer.add_header(toc_header)
             writer.add(TocMaker(self.strategy, self.header.outline_level - 1).make(self))
-        # Save it to the file
-        if self.has_file():
-            assert (not self.prev) == (not self.next)
-            if self.next and self.split_level and self.strategy.needs_navigation:   # No navbar for stand-alone ToC or a single-file project
-                writer.add(self._make_navigation())
-            with open(self.abs_filename, "x", encoding='utf-8') as output:
-                output.write(writer.get_output())
+    
+    # Yields the texts of the pages in their order
+    @staticmethod
+    def _render_pages(pages, writer_factory, jobs):
+        global _pages_to_render
+        if jobs == 1 or len(pages) < 2:
+            for p in pages:
+                yield p.render(writer_factory)
+            return
+        # Worker processes are forked to get a copy of the finished document instead of pickling it
+        _pages_to_render = (pages, writer_factory)
+        sys.stdout.flush()  # Otherwise the workers would print the buffered output once again
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork")) as pool:
+                for text, log in pool.map(_render_page, range(len(pages)), chunksize=max(len(pages) // (jobs * 4), 1)):
+                    print(log, end="")
+                    yield text
+        finally:
+            _pages_to_render = None
     
     def traverse(self, handler):
         if handler(self):
@@ -400,7 +495,7 @@ class Section:
     def _init_folder(self, abs_root, root_to_parent, filename):
         root_to_parent = self._join_paths(root_to_parent, filename)
         if abs_root:
-            os.mkdir(self._join_paths(abs_root, root_to_parent))
+            self.output.make_dir(self._join_paths(abs_root, root_to_parent))
         self.rel_filename = self._join_paths(root_to_parent, self.strategy.index_filename(filename) + self.strategy.file_extension)
         self.path_to_root = self._join_paths(self.parent.path_to_root, "..")
         self.type = SectionType.FOLDER
@@ -426,32 +521,33 @@ class Section:
         else:
             reverse[ref] = bookmarks
             
-    def _replace_bookmarks_in_content(self, c, mapping):
-        match c:
-            case Paragraph():
-                if c.bookmarks:
-                    c.bookmarks = [self._replace_single_bookmark(c.bookmarks, mapping),]
-            case List():
-                for i in c.items:
-                    self._replace_bookmarks_in_content(i, mapping)                    
+    # The content is indexed right before crosslinking as customizations may change it in any way
+    def _build_index(self):
+        self._bookmarked = []
+        self._linked = []
+        for c in self.content:
+            self._index_content(c, 0)
     
-    def _replace_links_in_content(self, c, mapping, broken):
+    # Bookmarks are collected from top-level paragraphs and replaced in lists as well
+    def _index_content(self, c, depth):
         match c:
             case Paragraph():
+                if c.bookmarks and depth is not None:
+                    self._bookmarked.append((c, depth == 0))
                 for s in c.spans:
                     if s.link:
-                        s.link = self._replace_single_link(s.link, mapping, broken)
+                        self._linked.append(s)
             case List():
                 for i in c.items:
-                    self._replace_links_in_content(i, mapping, broken)
+                    self._index_content(i, depth + 1 if depth is not None else None)
             case Table():
                 for r in c.rows:
                     for col in r:
-                        self._replace_links_in_content(col, mapping, broken)
+                        self._index_content(col, None)
             case DefinitionList():
                 for i in c.items:
-                    self._replace_links_in_content(i[0], mapping, broken)
-                    self._replace_links_in_content(i[1], mapping, broken)
+                    self._index_content(i[0], None)
+                    self._index_content(i[1], None)
     
     def _replace_single_bookmark(self, bookmarks, mapping):
         assert bookmarks
@@ -477,19 +573,10 @@ class Section:
     def _make_navigation(self):
         assert self.prev and self.next
         assert self.type != SectionType.NONE
+        assert self.prev_file and self.next_file
         navigation = NavBar()
-        # Find the next chapter
-        other = self
-        while not other.next.has_file():
-            other = other.next
-            assert other != self
-        navigation.next = self._make_nav_item(other.next)
-        # Find the prev chapter
-        other = self
-        while not other.prev.has_file():
-            other = other.prev
-            assert other != self
-        navigation.prev = self._make_nav_item(other.prev)
+        navigation.next = self._make_nav_item(self.next_file)
+        navigation.prev = self._make_nav_item(self.prev_file)
         # Find the parent
         if self.parent:
             navigation.up = self._make_nav_item(self.parent)
@@ -498,12 +585,45 @@ class Section:
     
     def _find_next_in_parent(self, current):
         while current.parent:
-            index = current.parent.children.index(current)
-            if index < len(current.parent.children) - 1:
-                return current.parent.children[index + 1]
+            if current.position < len(current.parent.children) - 1:
+                return current.parent.children[current.position + 1]
             current = current.parent
         return None
     
+    def _make_render_signature(self, writer_factory):
+        # Serialize everything that the writer and the customization may use to render this file
+        sections = []
+        self._collect_file_sections(sections)
+        navigation = self._make_navigation() if self.next and self.split_level and self.strategy.needs_navigation else None
+        toc = TocMaker(self.strategy, self.header.outline_level - 1).make(self).items if self.type == SectionType.FOLDER else None
+        customization = type(self.customization)
+        data = (repr(writer_factory),
+                (customization.__module__, customization.__qualname__, self.customization.get_render_signature()),
+                self.split_level,
+                self.rel_filename,
+                self.path_to_root,
+                self.type,
+                self.parent,
+                self.position,
+                navigation,
+                toc,
+                [(s.header, s.content, [c.header.to_string() for c in s.children]) for s in sections])
+        buffer = io.BytesIO()
+        _SignaturePickler(buffer).dump(data)
+        return buffer.getvalue()
+    
+    def _collect_pages(self, output):
+        output.append(self)
+        for child in self.children:
+            if child.has_file():
+                child._collect_pages(output)
+    
+    def _collect_file_sections(self, output):
+        output.append(self)
+        for child in self.children:
+            if not child.has_file():
+                child._collect_file_sections(output)
+    
     def _make_nav_item(self, other):
         return NavItem(other.header.to_string(), 
                        self.strategy.process_internal_link(self._join_paths(self.path_to_root, other.rel_filename)))
@@ -520,9 +640,32 @@ class Section:
             return ""
 
 
+# Pages rendered by worker processes: (list of sections, writer factory)
+_pages_to_render = None
+
+def _render_page(index):
+    pages, writer_factory = _pages_to_render
+    # Messages are printed by the parent process to keep them in order
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        text = pages[index].render(writer_factory)
+    return text, log.getvalue()
+
+
+# Sections are identified by their files and titles instead of being serialized with their subtrees
+class _SignaturePickler(pickle.Pickler):
+    def __init__(self, file):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+    
+    def persistent_id(self, obj):
+        if isinstance(obj, Section):
+            return (obj.rel_filename, obj.header.to_string())
+        return None
+
+
 class Document:
-    def __init__(self, destination: str, split_level: int, strategy: plugins.Strategy, customization: plugins.Customization):
-        Section.set_strategy(strategy, customization, split_level)
+    def __init__(self, destination: str, split_level: int, strategy: plugins.Strategy, customization: plugins.Customization, output: Optional[OutputFolder] = None):
+        Section.set_strategy(strategy, customization, split_level, output if output else OutputFolder(destination))
         self._destination = destination
         self._strategy = strategy
         self._root = Section(None, Header(DEFAULT_NAME))
@@ -531,6 +674,7 @@ class Document:
         
     def create_folders(self) -> None:
         self._root.create_folders(self._destination, "")
+        self._index_sections()
         
     def link_images(self, external_images: dict[str, ImageData], internal_images: dict[str, ImageData]) -> None:
         self._root.match_images(external_images, internal_images)
@@ -541,7 +685,10 @@ class Document:
         reverse = {}            # anchor, list[link]        - markdown to ODT multiple links map
         reverse_duplicates = {} # anchor, list[list[link]]  - duplicate markdown links
         remap = {}              # link, anchor              - these anchors are not headers, therefore they will be output as HTML
-        self._root.collect_bookmarks(direct, reverse, reverse_duplicates, remap)
+        sections = []
+        self._root.collect_sections(sections)
+        for s in sections:
+            s.collect_bookmarks(direct, reverse, reverse_duplicates, remap)
         assert not direct.keys() & remap.keys()
         # Rename duplicates
         print(f"Resolving {len(reverse_duplicates)} anchor conflicts:")
@@ -555,12 +702,14 @@ class Document:
                 assert l not in remap   # We cannot resolve conflicts from headers and conflicts from text paragraphs together
                 direct[l] = p
         # Commit the changes
-        self._root.replace_bookmarks(direct, remap)
-        self._root.replace_links(direct | remap, self._broken_links)
+        mapping = direct | remap
+        for s in sections:
+            s.replace_bookmarks(direct, remap)
+            s.replace_links(mapping, self._broken_links)
         self._assert_no_broken_links()
         
-    def dump(self, writer_factory) -> None:
-        self._root.dump(writer_factory)
+    def dump(self, writer_factory, renders = None, jobs: int = 1) -> None:
+        self._root.dump(writer_factory, renders, jobs)
         
     def root(self):
         return self._root
@@ -582,15 +731,16 @@ class Document:
         children = self._root.children
         self._root.children = []
         self._root.parent = new_root
-        # Prepend the moved elements into the existing tree
-        new_root.children.insert(0, self._root)     # push front
-        for c in reversed(children):
+        # Top-level sections move to the new root right after the old one, the rest stay in place
+        moved = [self._root,]
+        for c in children:
             assert c.header.outline_level
             if c.header.outline_level == 1:
-                new_root.children.insert(1, c)      # insert after self
+                moved.append(c)
                 c.parent = new_root
             else:
-                self._root.children.insert(0, c)    # compensate for the reverse
+                self._root.children.append(c)
+        new_root.children[0:0] = moved              # push front
         self._root.header.outline_level = 1
         self._root = new_root
     
@@ -610,6 +760,26 @@ class Document:
         self._current_section.next = self._root
         self._current_section = None        
     
+    # Precompute positions among siblings and the neighbouring pages for navigation
+    def _index_sections(self):
+        sections = []
+        self._root.collect_sections(sections)
+        for s in sections:
+            for i, c in enumerate(s.children):
+                c.position = i
+        # Pages follow each other in the order of the navigation list, which is looped
+        files = []
+        current = self._root
+        while current:
+            if current.has_file():
+                files.append(current)
+            current = current.next
+            if current is self._root:
+                break
+        for i, f in enumerate(files):
+            f.prev_file = files[i - 1]
+            f.next_file = files[(i + 1) % len(files)]
+    
     def _add_header(self, header):
         assert header.outline_level
         assert self._current_section
@@ -6,36 +6,34 @@ import md_writer
 
 
 class GithubMarkdownWriter(md_writer.MarkdownWriter):
-    def __init__(self, creator, split_level = 0, *, collapse_level = 0, toc_collapse_level = 0):
-        super().__init__(split_level)
+    def __init__(self, creator, split_level = 0, stream = None, *, collapse_level = 0, toc_collapse_level = 0):
+        super().__init__(split_level, stream)
         self._collapse_level = collapse_level
         self._toc_collapse_level = toc_collapse_level
         self._collapsing = False
         
-    def get_output(self) -> str:
+    def finish(self) -> None:
         if self._collapsing:
-            self._output.append("</details>\n")
+            self._add_block("</details>\n")
             self._collapsing = False
-        return super().get_output()
 
     def add_header(self, header: document.Header) -> None:
         # Skip chapter names as GitHub wiki shows file names anyway, and file names are the same as chapter names
         if header.outline_level > self._split_level:
             # Close the previous section
             if self._collapsing and header.outline_level <= self._collapse_level:
-                self._output.append("</details>")
+                self._add_block("</details>")
                 self._collapsing = False
             # Write the new section
             if header.outline_level == self._collapse_level:
-                self._output.append("<details>\n<summary>")
+                self._add_block("<details>\n<summary>")
                 self._collapsing = True
             super().add_header(header)
             if self._collapsing:
-                self._output.append("\n</summary>")
+                self._add_block("\n</summary>")
     
-    def _add_toc(self, toc):
+    def _write_toc(self, output, toc):
         assert self._toc_collapse_level in (0, 1) # Cannot collapse inside a list
-        output = []
         for i in toc.items:
             assert i.level > 0
             assert i.name
@@ -47,17 +45,16 @@ class GithubMarkdownWriter(md_writer.MarkdownWriter):
                     link_text = f"[[{i.name}|{i.link[1:-1]}]]"
                 else:
                     link_text = f"[{i.name}]({i.link})"
-                output.append("  " * (i.level - 2) + "- " + link_text)
+                output.append_line("  " * (i.level - 2) + "- " + link_text)
             else:        
                 if self._collapsing:
-                    output.append("\n</details>\n")
+                    output.append_line("\n</details>\n")
                 if self._toc_collapse_level:
                     self._collapsing = True
                     # Markdown does not work inside <summary>
-                    output.append(f'<details>\n<summary><a href="{self._strip_link(i.link)}">{i.name}</a></summary>\n')
+                    output.append_line(f'<details>\n<summary><a href="{self._strip_link(i.link)}">{i.name}</a></summary>\n')
                 else:
-                    output.append(f"\n### [{i.name}]({i.link})\n")
-        return "\n".join(output)
+                    output.append_line(f"\n### [{i.name}]({i.link})\n")
     
     @staticmethod
     def _open_link(link):
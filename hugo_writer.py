@@ -11,8 +11,8 @@ class HugoMarkdownWriter(md_writer.MarkdownWriter):
         md_writer.ColorId.GREEN:    "book-green"
     }
     
-    def __init__(self, creator, split_level = 0):
-        super().__init__(split_level)
+    def __init__(self, creator, split_level = 0, stream = None):
+        super().__init__(split_level, stream)
         self._in_list = 0
         self._first_header = True
         self._make_metadata(creator)
@@ -22,7 +22,7 @@ class HugoMarkdownWriter(md_writer.MarkdownWriter):
         if self._first_header:
             header += " {anchor=false}"
             self._first_header = False
-        self._output.append(header)
+        self._add_block(header)
         
     def _strip_link(self, link):
         assert link.startswith('{{< relref "')
@@ -31,33 +31,25 @@ class HugoMarkdownWriter(md_writer.MarkdownWriter):
     
     def _add_paragraph(self, paragraph, write_anchor):
         assert self._in_list >= 0
-        aside = False
-        result = ""
         if paragraph.grayed_out and not self._in_list:
-            aside = True
-            result += ("<aside>" + self.PARAGRAPH_SEPARATOR)
-        result += super()._add_paragraph(paragraph, write_anchor)
-        if aside:
-            result += self.PARAGRAPH_SEPARATOR + "</aside>"
-        return result
+            return self.PARAGRAPH_SEPARATOR.join(("<aside>", super()._add_paragraph(paragraph, write_anchor), "</aside>"))
+        return super()._add_paragraph(paragraph, write_anchor)
             
-    def _add_list(self, l, offset = 0):
+    def _write_list(self, output, l, offset):
         self._in_list += 1
-        result = super()._add_list(l, offset)
+        super()._write_list(output, l, offset)
         self._in_list -= 1
-        return result
            
-    def _make_image_html(self, image, presentation, scale, caption):
+    def _write_image_html(self, output, image, presentation, scale, caption):
         # Generate the HTML code      
-        output = []
-        output.append('<figure>')
-        output.append(f'<a href="{self._escape_link(image.original)}">')
-        output.extend(self._add_picture(image, presentation, scale))
-        output.append('</a>')
+        output.append_line('<figure>')
+        output.append_line(f'<a href="{self._escape_link(image.original)}">')
+        for line in self._add_picture(image, presentation, scale):
+            output.append_line(line)
+        output.append_line('</a>')
         if caption:
-            output.append("<figcaption>" + caption + "</figcaption>")
-        output.append('</figure>')
-        return "\n".join(output)
+            output.append_line("<figcaption>" + caption + "</figcaption>")
+        output.append_line('</figure>')
     
     def _add_picture(self, image, presentation, scale = None):
         output = []
@@ -77,51 +69,55 @@ class HugoMarkdownWriter(md_writer.MarkdownWriter):
             output.append('</picture>')
         return output
     
-    def _add_toc(self, toc):
-        output = []
+    def _write_toc(self, output, toc):
+        separator = self.PARAGRAPH_SEPARATOR
         grid = self._customization.toc_grid_depth_and_style(toc.root)
         if grid:
             # Add a CSS grid ToC
             max_level, css_class = grid
-            output.append(f'<nav class="{css_class}">')
+            output.append_line(f'<nav class="{css_class}">', separator)
             for i in toc.items:
                 assert i.level > 0
                 assert i.name
                 assert i.link
                 if i.level < max_level:
                     # A grid-wide header
-                    output.append(f'<a class="{self._customization.grid_wide_class}" href="{i.link}">')
-                    output.append("<h2>" + i.name + "</h2>")
-                    output.append('</a>')
+                    output.append_line(f'<a class="{self._customization.grid_wide_class}" href="{i.link}">', separator)
+                    output.append_line("<h2>" + i.name + "</h2>", separator)
+                    output.append_line('</a>', separator)
                 elif i.level == max_level:
                     picture = self._customization.get_toc_image(i.name)
                     if isinstance(picture, plugins.Wide):
                         # A grid-wide normal text
-                        output.append(f'<a class="{self._customization.grid_wide_class}" href="{i.link}">')
-                        output.append(i.name)
-                        output.append('</a>')
+                        output.append_line(f'<a class="{self._customization.grid_wide_class}" href="{i.link}">', separator)
+                        output.append_line(i.name, separator)
+                        output.append_line('</a>', separator)
                     elif picture:
                         # A single-cell image and text
-                        output.append(f'<a href="{i.link}">')
-                        output.extend(self._add_picture(picture, self._make_image_presentation(picture)))
-                        output.append(i.name.split("(")[0].strip())    # Make the name shorter
-                        output.append('</a>')
+                        output.append_line(f'<a href="{i.link}">', separator)
+                        for line in self._add_picture(picture, self._make_image_presentation(picture)):
+                            output.append_line(line, separator)
+                        output.append_line(i.name.split("(")[0].strip(), separator)    # Make the name shorter
+                        output.append_line('</a>', separator)
                     else:
                         # A single-cell normal text
-                        output.append(f'<a href="{i.link}">')
-                        output.append(i.name.split("(")[0].strip())    # Make the name shorter
-                        output.append('</a>')
+                        output.append_line(f'<a href="{i.link}">', separator)
+                        output.append_line(i.name.split("(")[0].strip(), separator)    # Make the name shorter
+                        output.append_line('</a>', separator)
                 # Else skip the item as it is too deep in the ToC tree
         else:
             # Add a list-based ToC
-            output.append("<nav>")
-            output.append(super()._add_toc(toc))
+            output.append_line("<nav>", separator)
+            output.separate(separator)
+            super()._write_toc(output, toc)
         # Finalize
-        output.append("</nav>")
-        return self.PARAGRAPH_SEPARATOR.join(output)
+        output.append_line("</nav>", separator)
     
-    def _add_nav_bar(self, navbar):
-        return "<nav>" + self.PARAGRAPH_SEPARATOR + super()._add_nav_bar(navbar) + self.PARAGRAPH_SEPARATOR + "</nav>"
+    def _write_nav_bar(self, output, navbar):
+        output.append_line("<nav>", self.PARAGRAPH_SEPARATOR)
+        output.separate(self.PARAGRAPH_SEPARATOR)
+        super()._write_nav_bar(output, navbar)
+        output.append_line("</nav>", self.PARAGRAPH_SEPARATOR)
     
     def _make_color_style(self, color):
         return f'class="{self._color_styles[color]}"'
@@ -130,7 +126,7 @@ class HugoMarkdownWriter(md_writer.MarkdownWriter):
         # Open a front matter
         output = [self.METADATA_SEPARATOR,]
         # Set up front matter fields
-        weight = 1 + creator.parent.children.index(creator) if creator.parent else 1
+        weight = 1 + creator.position if creator.parent else 1
         output.append(f"weight = {weight}")
         title = creator.header.to_string()
         if not creator.parent:
@@ -164,7 +160,7 @@ class HugoMarkdownWriter(md_writer.MarkdownWriter):
             output.append(f"  priority = {self._customization.get_sitemap_priority(creator)}")
         # Write the front matter
         output.append(self.METADATA_SEPARATOR)
-        self._output.append("\n".join(output))
+        self._add_block("\n".join(output))
         
 
 class HugoStrategy(plugins.Strategy):
@@ -0,0 +1,85 @@
+"Reading dimensions of images from their headers without decoding the pixels"
+
+import re
+import struct
+
+import svg_tools
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+GIF_SIGNATURES = (b"GIF87a", b"GIF89a")
+JPEG_SIGNATURE = b"\xff\xd8"
+# Start of frame markers, which contain the dimensions. The others with the same high nibble are DHT, JPG and DAC.
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+# Markers without a length
+JPEG_STANDALONE_MARKERS = set(range(0xd0, 0xda)) | {0x01}
+SVG_PREFIX_LENGTH = 4096
+
+
+def _png(data):
+    if len(data) < 24 or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])
+
+def _gif(data):
+    if len(data) < 10:
+        return None
+    return struct.unpack("<HH", data[6:10])
+
+def _jpeg(data):
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xff:
+            return None
+        marker = data[offset + 1]
+        # Fill bytes
+        if marker == 0xff:
+            offset += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        length = struct.unpack(">H", data[offset + 2 : offset + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[offset + 5 : offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+def _webp(data):
+    if len(data) < 30:
+        return None
+    match data[12:16]:
+        case b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3fff, height & 0x3fff
+        case b"VP8L":
+            b0, b1, b2, b3 = data[21:25]
+            return 1 + (((b1 & 0x3f) << 8) | b0), 1 + (((b3 & 0xf) << 10) | (b2 << 2) | ((b1 & 0xc0) >> 6))
+        case b"VP8X":
+            return 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little")
+    return None
+
+def _svg(data):
+    text = data[:SVG_PREFIX_LENGTH].decode("utf-8", errors="ignore")
+    tag = re.search(r"<svg\b[^>]*>", text)
+    return svg_tools.find_dimensions(tag[0]) if tag else None
+
+
+# Width and height of a PNG, JPEG, GIF, WebP or SVG image, None for other formats or sizes given in units other than pixels
+def get_dimensions(data):
+    if data.startswith(PNG_SIGNATURE):
+        dimensions = _png(data)
+    elif data.startswith(JPEG_SIGNATURE):
+        dimensions = _jpeg(data)
+    elif data.startswith(GIF_SIGNATURES):
+        dimensions = _gif(data)
+    elif data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        dimensions = _webp(data)
+    else:
+        dimensions = _svg(data)
+    if not dimensions or not all(dimensions):
+        return None
+    return dimensions
@@ -3,21 +3,40 @@
 has_image_matcher = True
 
 try:
+    import PIL
     from PIL import Image, UnidentifiedImageError
 except ModuleNotFoundError:
     has_image_matcher = False
 
 from zipfile import ZipFile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import contextlib
+import functools
+import io
+import operator
 import os
+import sys
 import math
+import multiprocessing
+import multiprocessing.util
+import time
 
+import cache
+import image_header
 from document import ImageData
+from output_folder import OutputFolder
 
 
 PICTURES_FOLDER = "Pictures/"
 THUMBNAIL_FILE = "Thumbnails/thumbnail.png"
 IMAGE_DEST_PREFIX = "image"
+HASH_NAME_LENGTH = 16   # Hex digits of the content hash in names of extracted images
+REDUCED_SIZE = 512      # The minimal size of JPEG images decoded for fast matching
+HASH_SIZE = 8           # The perceptual hash compares HASH_SIZE x HASH_SIZE pairs of neighbouring pixels
+HASH_DISTANCE = 4       # The maximal number of different bits for images to be considered the same
+HASH_MARGIN = 4         # How many bits farther than the closest hash the next one should be to tell them apart
 
 
 def _assert(_):
@@ -25,38 +44,120 @@ def _assert(_):
     
 def _calc_stat_for_channel(histogram, channel_index, numpixels):
     offset = channel_index * 256
-    return sum([histogram[offset + i] * i for i in range(256)]) / numpixels
+    return sum(map(operator.mul, histogram[offset : offset + 256], range(256))) / numpixels
 
 def _calc_stats(image):
-    assert len(image.getbands()) == 4
     numpixels = image.width * image.height
     histogram = image.histogram()
+    # Same as for the image converted to RGBA, where every color channel is a copy of the gray one
+    if image.mode == "L":
+        gray = _calc_stat_for_channel(histogram, 0, numpixels)
+        return _Stats(gray, gray, gray)
+    assert len(image.getbands()) in (3, 4)
     return _Stats(  _calc_stat_for_channel(histogram, 0, numpixels), 
                     _calc_stat_for_channel(histogram, 1, numpixels), 
                     _calc_stat_for_channel(histogram, 2, numpixels))
 
-def _load_image(source):
+# Difference hash: a bit per pair of horizontally adjacent pixels of a tiny grayscale thumbnail, set if the left one is brighter.
+# It survives resizing and recompression, which change the mean colors, and tells apart images of similar colors.
+def _calc_dhash(image):
+    thumbnail = image.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX)
+    if thumbnail.mode != "L":
+        thumbnail = thumbnail.convert("L")
+    pixels = list(thumbnail.getdata())
+    dhash = 0
+    for row in range(0, len(pixels), HASH_SIZE + 1):
+        for left, right in zip(pixels[row : row + HASH_SIZE], pixels[row + 1 : row + HASH_SIZE + 1]):
+            dhash = (dhash << 1) | (left > right)
+    return dhash
+
+def _hash_distance(first, second):
+    return (first ^ second).bit_count()
+
+# Returns the image and its size. Color means change little when an image is downscaled, 
+# therefore a reduced image may be decoded if the format supports that (only JPEG does).
+def _load_image(source, reduced = False):
     with Image.open(source) as image:
+        size = image.size
+        if reduced:
+            image.draft(None, (REDUCED_SIZE, REDUCED_SIZE))
         image.load()
-    if len(image.getbands()) == 1:
+    if len(image.getbands()) == 1 and image.mode != "L":
         image = image.convert("RGBA")
-    assert len(image.getbands()) == 4
-    return image
+    assert len(image.getbands()) in (3, 4) or image.mode == "L"
+    return image, size
+
+# Width, height, color statistics and the perceptual hash of an image
+def _fingerprint_image(source, reduced = False):
+    img, (width, height) = _load_image(source, reduced)
+    stats = _calc_stats(img)
+    return width, height, stats.r, stats.g, stats.b, _calc_dhash(img)
+
+# Same for a local file, followed by the hash of its content. None if it is not an image.
+def _fingerprint_file(filename, reduced = False):
+    with open(filename, "rb") as file:
+        data = file.read()
+    try:
+        with io.BytesIO(data) as source:
+            return *_fingerprint_image(source, reduced), cache.hash_bytes(data)
+    except UnidentifiedImageError:
+        return None
+
+def _fingerprint_member(archive, name, reduced = False):
+    with archive.open(name) as source:
+        return _fingerprint_image(source, reduced)
+
+
+# Images are decoded in worker processes, each of them opens the ODT on its own
+_worker_archive = None
+
+def _open_worker_archive(filename):
+    global _worker_archive
+    _worker_archive = ZipFile(filename)
+    # Workers end with os._exit(), which skips atexit hooks but runs the multiprocessing finalizers
+    multiprocessing.util.Finalize(None, _worker_archive.close, exitpriority=10)
+
+def _fingerprint_member_in_worker(name, reduced):
+    return _fingerprint_member(_worker_archive, name, reduced)
+
+def _create_pool(archive, jobs):
+    if jobs == 1:
+        return contextlib.nullcontext()
+    assert archive.filename
+    # Same start method as for rendering the pages, which is checked when the options are parsed
+    return ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork"), initializer=_open_worker_archive, initargs=(archive.filename,))
+
+# Results are returned in the order of items in any case
+def _map(pool, jobs, method, items):
+    if not pool:
+        return list(map(method, items))
+    return list(pool.map(method, items, chunksize=max(len(items) // (jobs * 4), 1)))
+
+# Fingerprints are cached by file name, size and modification time as decoding the images takes most of the time
+def _open_fingerprints_cache(cache_dir, image_folder, reduced):
+    storage = cache.Cache(cache_dir, ("images-reduced-" if reduced else "images-") + cache.hash_string(os.path.abspath(image_folder)))
+    key = (cache.hash_modules(sys.modules[__name__]), PIL.__version__)
+    return storage, key
 
 class _Stats:
+    STRICT_TOLERANCE = 0.0001
+    LOOSE_TOLERANCE = 0.15
+    DOUBLE_TOLERANCE = 0.2
+    HASH_TOLERANCE = 0.5    # Re-encoding and resizing change the means by up to 0.2
+    
     def __init__(self, r, g, b):
         self.r = r
         self.g = g
         self.b = b
         
     def eq_strict(self, other):
-        return self._eq(other, 0.0001)
+        return self._eq(other, self.STRICT_TOLERANCE)
     
     def eq_loose(self, other):
-        return self._eq(other, 0.15)
+        return self._eq(other, self.LOOSE_TOLERANCE)
     
     def eq_double(self, other):
-        return self._eq(other, 0.2)
+        return self._eq(other, self.DOUBLE_TOLERANCE)
     
     def _eq(self, other, abs_tolerance):
         return math.isclose(self.r, other.r, rel_tol=0, abs_tol=abs_tolerance) \
@@ -68,114 +169,304 @@ class _Stats:
 
 
 class _FileRecord:
-    def __init__(self, filename, stats):
+    def __init__(self, filename, stats, dhash, digest):
         self.filename = filename
         self.stats = stats
+        self.dhash = dhash
+        self.digest = digest
+        self.has_similar = False    # There is a local image of similar colors, the hashes should be checked to match this one
     
     def __repr__(self):
-        return self.filename + ": " + repr(self.stats)
+        return self.filename + ": " + repr(self.stats) + f", hash {self.dhash:016x}"
+
+
+# Burkhard-Keller tree: finds hashes within a Hamming distance without comparing to every hash.
+# Each child is at the given distance from its parent, thus the triangle inequality limits the subtrees to visit.
+class _BKTree:
+    def __init__(self):
+        self._root = None       # [hash, list[item], dict[distance, child]]
+    
+    def add(self, dhash, item):
+        if not self._root:
+            self._root = [dhash, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = _hash_distance(dhash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if not child:
+                node[2][distance] = [dhash, [item], {}]
+                return
+            node = child
+    
+    # list[(distance, item)]
+    def find(self, dhash, max_distance):
+        found = []
+        to_visit = [self._root] if self._root else []
+        while to_visit:
+            node = to_visit.pop()
+            distance = _hash_distance(dhash, node[0])
+            if distance <= max_distance:
+                found.extend([(distance, i) for i in node[1]])
+            for d, child in node[2].items():
+                if distance - max_distance <= d <= distance + max_distance:
+                    to_visit.append(child)
+        return found
 
 
-def match_images(archive: ZipFile, image_folder: str) -> tuple[dict[str, ImageData], dict[str, ImageData]]:
+# A grid hash over (aspect, r, g, b) of local images. The color cells are not smaller than the largest tolerance,
+# thus any image within the tolerance is found in the cell of the query or in the cells next to it.
+class _ImageIndex:
+    CELL_SIZE = _Stats.DOUBLE_TOLERANCE
+    
+    def __init__(self):
+        self._cells = defaultdict(list)         # (aspect, r, g, b), list[(order, _FileRecord)]
+        self._aspects = defaultdict(list)       # aspect, list[_FileRecord]
+        self._hashes = _BKTree()                # (aspect, order, _FileRecord)
+        self._contents = {}                     # digest, _FileRecord
+        self._count = 0
+        self.build_time = 0
+        self.query_time = 0
+        self.num_queries = 0
+    
+    def add(self, aspect, record):
+        start = time.perf_counter()
+        self._cells[(aspect, *self._cell(record.stats))].append((self._count, record))
+        self._aspects[aspect].append(record)
+        self._hashes.add(record.dhash, (aspect, self._count, record))
+        self._contents.setdefault(record.digest, record)
+        self._count += 1
+        self.build_time += time.perf_counter() - start
+    
+    # Images with aspects in the range (ends included) and stats within the tolerance, 
+    # in the order of aspects and then of registration
+    def find(self, first_aspect, last_aspect, stats, tolerance):
+        assert tolerance <= self.CELL_SIZE
+        start = time.perf_counter()
+        r, g, b = self._cell(stats)
+        found = []
+        for a in range(first_aspect, last_aspect + 1):
+            in_aspect = []
+            for cell_r in (r - 1, r, r + 1):
+                for cell_g in (g - 1, g, g + 1):
+                    for cell_b in (b - 1, b, b + 1):
+                        cell = self._cells.get((a, cell_r, cell_g, cell_b))
+                        if cell:
+                            in_aspect.extend([e for e in cell if e[1].stats._eq(stats, tolerance)])
+            in_aspect.sort(key=lambda e: e[0])
+            found.extend([(a, e[1]) for e in in_aspect])
+        self.query_time += time.perf_counter() - start
+        self.num_queries += 1
+        return found
+    
+    # Images with aspects in the range and hashes within the distance, in the same order as above
+    def find_by_hash(self, first_aspect, last_aspect, dhash, max_distance):
+        start = time.perf_counter()
+        found = [e for _, e in self._hashes.find(dhash, max_distance) if first_aspect <= e[0] <= last_aspect]
+        found.sort(key=lambda e: (e[0], e[1]))
+        self.query_time += time.perf_counter() - start
+        self.num_queries += 1
+        return [(a, r) for a, _, r in found]
+    
+    # The image with exactly the same file content
+    def find_by_content(self, digest):
+        return self._contents.get(digest)
+    
+    def in_aspect(self, aspect):
+        return self._aspects.get(aspect, [])
+    
+    def _cell(self, stats):
+        return math.floor(stats.r / self.CELL_SIZE), math.floor(stats.g / self.CELL_SIZE), math.floor(stats.b / self.CELL_SIZE)
+
+
+def match_images(archive: ZipFile, image_folder: str, cache_dir: Optional[str] = None, jobs: int = 1, reduced: bool = False, hash_matching: bool = False) -> tuple[dict[str, ImageData], dict[str, ImageData]]:
     assert has_image_matcher
+    assert jobs > 0
+    with _create_pool(archive, jobs) as pool:
+        local_data, index = _process_local_images(image_folder, cache_dir, pool, jobs, reduced, hash_matching)
+        return _match_odt_images(archive, local_data, index, pool, jobs, reduced, hash_matching)
+
+def _process_local_images(image_folder, cache_dir, pool, jobs, reduced, hash_matching):
     # Calculate statistics for each image in the local images directory
     has_ambiguous = False
-    aspect_ratios = defaultdict(list)
+    index = _ImageIndex()
     print("Processing local images...")
     prefix_path_length = len(image_folder) + 1
     local_data = {}
+    if cache_dir:
+        storage, key = _open_fingerprints_cache(cache_dir, image_folder, reduced)
+        old_fingerprints = storage.load(key) or {}
+    else:
+        old_fingerprints = {}
+    # Find the images which have changed since the last run
+    fingerprints = {}   # file name, ((size, modification time), fingerprint)
+    to_decode = []
     for path, _, files in os.walk(image_folder, onerror=_assert):
         for f in files:
-            try:
-                # Open the image
-                filename = os.path.join(path, f)
-                # Load the image
-                img = _load_image(filename)
-                assert filename not in local_data
-                local_data[filename] = ImageData(filename, img.width, img.height, filename[prefix_path_length:])
-                aspect = int(img.width / img.height * 100)
-                stats = _calc_stats(img)
-                # Make sure there are no similar images
-                for a in range(aspect - 2, aspect + 3):
-                    for r in aspect_ratios[a]:
-                        if r.stats.eq_double(stats):
-                            has_ambiguous = True
-                            print(f"Similar images:")
-                            print(f"{a}: {r}")
-                            print(f"{aspect}: {_FileRecord(filename, stats)}")
-                            print()
-                # Register the image
-                aspect_ratios[aspect].append(_FileRecord(filename, stats))
-            except UnidentifiedImageError:
-                pass
+            filename = os.path.join(path, f)
+            stat = os.stat(filename)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            cached = old_fingerprints.get(filename)
+            if cached and cached[0] == signature:
+                fingerprints[filename] = cached
+            else:
+                fingerprints[filename] = (signature, None)
+                to_decode.append(filename)
+    # Decode them
+    for filename, fingerprint in zip(to_decode, _map(pool, jobs, functools.partial(_fingerprint_file, reduced=reduced), to_decode)):
+        fingerprints[filename] = (fingerprints[filename][0], fingerprint)
+    # Register the images in the order of the folder walk
+    for filename, (_, fingerprint) in fingerprints.items():
+        if not fingerprint:
+            continue
+        width, height, r, g, b, dhash, digest = fingerprint
+        assert filename not in local_data
+        local_data[filename] = ImageData(filename, width, height, filename[prefix_path_length:])
+        aspect = int(width / height * 100)
+        record = _FileRecord(filename, _Stats(r, g, b), dhash, digest)
+        # Make sure there are no similar images. With hash matching, images of similar colors are told apart by their hashes 
+        # if any copy of one of them is closer to it than to the other one by HASH_MARGIN.
+        for a, other in index.find(aspect - 2, aspect + 2, record.stats, _Stats.DOUBLE_TOLERANCE):
+            if hash_matching and _hash_distance(other.dhash, dhash) > HASH_DISTANCE * 2 + HASH_MARGIN:
+                other.has_similar = record.has_similar = True
+                continue
+            has_ambiguous = True
+            print(f"Similar images:")
+            print(f"{a}: {other}")
+            print(f"{aspect}: {record}")
+            print()
+        # Register the image
+        index.add(aspect, record)
+    if cache_dir:
+        print(f"Local images reused from the cache: {len(fingerprints) - len(to_decode)}, decoded: {len(to_decode)}")
+        if fingerprints != old_fingerprints:
+            storage.store(key, fingerprints)
     assert not has_ambiguous
     print(f"{len(local_data)} local images were processed sucessfully")
+    return local_data, index
+
+def _match_odt_images(archive, local_data, index, pool, jobs, reduced, hash_matching):
     # Match images from the ODT to the local images
+    has_ambiguous = False
     matched = {}
     unmatched = {}
-    infos = archive.infolist()
+    names = [i.filename for i in archive.infolist() if i.filename.startswith(PICTURES_FOLDER)]
     perfect_matches = 0
     loose_matches = 0
+    hash_matches = 0
     print("Processing images in the ODT...")
-    for i in infos:
-        if i.filename.startswith(PICTURES_FOLDER):
-            assert i.filename not in matched
-            assert i.filename not in unmatched
-            # Open the image
-            with archive.open(i) as img_file:
-                img = _load_image(img_file)
-            aspect = int(img.width / img.height * 100)
-            stats = _calc_stats(img)
-            # Find a strictly matching local image
-            found = None
-            for r in aspect_ratios[aspect]:
-                if r.stats.eq_strict(stats):
-                    assert not found
-                    found = r.filename
-                    perfect_matches += 1
-            # Looser match for resized images
-            if not found:
-                for a in range(aspect - 1, aspect + 2):
-                    for r in aspect_ratios[a]:
-                        if r.stats.eq_loose(stats):
-                            if found:
-                                has_ambiguous = True
-                                print(f"Ambiguous match from {i.filename} to: {r.filename} and {found}")
-                            found = r.filename
-                            loose_matches += 1
-            if not found:
-                print("Unmatched:", i.filename, aspect, stats)
-                for a in range(aspect - 1, aspect + 2):
-                    print("->", a)
-                    for r in aspect_ratios[a]:
-                        print(r)
-                print()
-            # Write down results
+    # Images which were inserted from the local folder are copies of the local files, thus there is no need to decode them
+    to_decode = []
+    for name in names:
+        record = index.find_by_content(cache.hash_members(archive, name))
+        if record:
+            matched[name] = local_data[record.filename]
+        else:
+            to_decode.append(name)
+    content_matches = len(matched)
+    if pool:
+        fingerprints = _map(pool, jobs, functools.partial(_fingerprint_member_in_worker, reduced=reduced), to_decode)
+    else:
+        fingerprints = [_fingerprint_member(archive, n, reduced) for n in to_decode]
+    for name, (width, height, r, g, b, dhash) in zip(to_decode, fingerprints):
+        assert name not in matched
+        assert name not in unmatched
+        aspect = int(width / height * 100)
+        stats = _Stats(r, g, b)
+        # Find a strictly matching local image. Images of the same colors, e.g. mirrored ones, are told apart by their hashes.
+        candidates = [r for _, r in index.find(aspect, aspect, stats, _Stats.STRICT_TOLERANCE)]
+        found = _choose_candidate(name, candidates, dhash)
+        if found:
+            perfect_matches += 1
+        # Looser match for resized images
+        if not candidates:
+            candidates = [r for _, r in index.find(aspect - 1, aspect + 1, stats, _Stats.LOOSE_TOLERANCE)]
+            found = _choose_candidate(name, candidates, dhash)
             if found:
-                matched[i.filename] = local_data[found]
-            else:
-                unmatched[i.filename] = ImageData(i.filename, img.width, img.height)
+                loose_matches += 1
+        if candidates and not found:
+            has_ambiguous = True
+        # Images which were re-encoded so that their colors changed too much. Hashes of plain diagrams carry few bits,
+        # therefore this is enabled explicitly and still requires the colors to be close.
+        if not found and not candidates and hash_matching:
+            closest = _find_closest_hash([r for _, r in index.find_by_hash(aspect - 1, aspect + 1, dhash, HASH_DISTANCE + HASH_MARGIN)], dhash)
+            if closest and closest.stats._eq(stats, _Stats.HASH_TOLERANCE):
+                found = closest
+                hash_matches += 1
+        if not found:
+            print("Unmatched:", name, aspect, stats, f"hash {dhash:016x}")
+            for a in range(aspect - 1, aspect + 2):
+                print("->", a)
+                for r in index.in_aspect(a):
+                    print(r)
+            print()
+        # Write down results
+        if found:
+            matched[name] = local_data[found.filename]
+        else:
+            unmatched[name] = ImageData(name, width, height)
+    # Keep the order of the images in the ODT
+    matched = {n: matched[n] for n in names if n in matched}
+    print(f"Matched by content: {content_matches}, strictly: {perfect_matches}, loosely: {loose_matches}, by the perceptual hash: {hash_matches}")
+    print(f"Image index: {index.num_queries} queries in {index.query_time:.3f} s, built in {index.build_time:.3f} s")
     assert not has_ambiguous
     print(f"ODT images were processed sucessfully. Matched: {len(matched)}, unmatched: {len(unmatched)}")
     return matched, unmatched, local_data
 
-def extract_images(archive: ZipFile, destination: str, names: dict[str, ImageData]):
-    archive.extractall(destination, names)
-    pictures_folder_name_len = len(PICTURES_FOLDER)
+# The only candidate, or the one with the closest hash if there are several. None if they cannot be told apart.
+def _choose_candidate(name, candidates, dhash):
+    if not candidates:
+        return None
+    # A copy of an image may have drifted in colors closer to another image of similar colors
+    if len(candidates) == 1 and not (candidates[0].has_similar and _hash_distance(candidates[0].dhash, dhash) > HASH_DISTANCE):
+        return candidates[0]
+    closest = _find_closest_hash(candidates, dhash)
+    if not closest:
+        print(f"Ambiguous match from {name} to: " + " and ".join([r.filename for r in candidates]))
+    return closest
+
+# The record with the closest hash within HASH_DISTANCE, None if there is no such record 
+# or if the next closest one is less than HASH_MARGIN bits farther
+def _find_closest_hash(records, dhash):
+    distances = sorted([(_hash_distance(r.dhash, dhash), i) for i, r in enumerate(records)])
+    if not distances or distances[0][0] > HASH_DISTANCE:
+        return None
+    if len(distances) > 1 and distances[1][0] - distances[0][0] < HASH_MARGIN:
+        return None
+    return records[distances[0][1]]
+
+def extract_images(archive: ZipFile, destination: str, names: dict[str, ImageData], output: OutputFolder, hash_names: bool = False):
     pictures_rel_path = os.path.join(PICTURES_FOLDER[:-1], "")
     pictures_abs_path = os.path.join(destination, pictures_rel_path)
+    if names:
+        output.make_dir(pictures_abs_path)
     index = 0
+    written = set()
     for n, d in names.items():
         assert n.startswith(PICTURES_FOLDER)
         suffix = os.path.splitext(n)[1]
         assert suffix
-        new_rel_name = os.path.join(pictures_rel_path, f"{IMAGE_DEST_PREFIX}{index:03d}{suffix}")
-        os.rename(os.path.join(pictures_abs_path, n[pictures_folder_name_len:]), os.path.join(destination, new_rel_name))
+        data = archive.read(n)
+        # Names derived from the content do not change when other images are added to or removed from the document
+        if hash_names:
+            new_rel_name = os.path.join(pictures_rel_path, f"{IMAGE_DEST_PREFIX}-{cache.hash_bytes(data)[:HASH_NAME_LENGTH]}{suffix}")
+        else:
+            new_rel_name = os.path.join(pictures_rel_path, f"{IMAGE_DEST_PREFIX}{index:03d}{suffix}")
+        # Images which were not matched have been decoded already
+        if not d.width:
+            d.width, d.height = image_header.get_dimensions(data) or (0, 0)
+        # Identical pictures share the file
+        if new_rel_name not in written:
+            output.write_bytes(os.path.join(destination, new_rel_name), data)
+            written.add(new_rel_name)
         d.set_link(new_rel_name)
         index += 1
-    print(f"Extracted {index} images to {pictures_abs_path}")
+    print(f"Extracted {len(written)} images to {pictures_abs_path}")
 
-def extract_all_images(archive: ZipFile, destination: str) -> dict[str, str]:
+def extract_all_images(archive: ZipFile, destination: str, output: OutputFolder, hash_names: bool = False) -> dict[str, str]:
     unmatched = {n: ImageData(n) for n in archive.namelist() if n.startswith(PICTURES_FOLDER)}
-    extract_images(archive, destination, unmatched)
+    extract_images(archive, destination, unmatched, output, hash_names)
     return unmatched
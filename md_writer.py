@@ -1,10 +1,19 @@
 "Markdown writers"
 
 import document
+import io
 import os.path
+import re
 from enum import Enum, auto, unique
 
 
+# Characters to escape in markdown text. The backslash goes first, otherwise the escapes would be escaped again.
+SPECIAL_CHARACTERS = "\\`*_~(){}[]<>#+-.!|"
+
+_special_characters_regexp = re.compile("[" + re.escape(SPECIAL_CHARACTERS) + "]")
+_escapes = [(c, "\\" + c) for c in SPECIAL_CHARACTERS]
+
+
 @unique
 class ColorId(Enum):
     DEFAULT = auto()
@@ -14,6 +23,35 @@ class ColorId(Enum):
     def __bool__(self):
         return self is not ColorId.DEFAULT
 
+
+# Receives the text of a page fragment by fragment and writes it to a stream, either a file or an in-memory buffer
+class PageSink:
+    def __init__(self, stream = None):
+        self._stream = stream if stream is not None else io.StringIO()
+        self._pending = None
+        self._started = False
+        self.fragments = 0
+    
+    # Puts a separator before the next fragment. The first separator wins, so that a block separator is not replaced by a line one.
+    def separate(self, separator):
+        if self._started and self._pending is None:
+            self._pending = separator
+    
+    def append(self, fragment):
+        if self._pending is not None:
+            self._stream.write(self._pending)
+            self._pending = None
+        self._stream.write(fragment)
+        self._started = True
+        self.fragments += 1
+    
+    def append_line(self, line, separator = "\n"):
+        self.separate(separator)
+        self.append(line)
+    
+    def getvalue(self):
+        return self._stream.getvalue()
+
     
 class MarkdownWriter:
     PARAGRAPH_SEPARATOR = "\n\n"
@@ -23,41 +61,59 @@ class MarkdownWriter:
         ColorId.GREEN:    "green"
     }
     
+    # Markup which changes one style into another, cached per writer class as the classes render styles differently
+    _transitions = {}
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._transitions = {}
+    
     @classmethod
     def set_customization(cls, customization):
         cls._customization = customization
     
-    def __init__(self, split_level):
-        self._output = []
+    # The page is written into the stream as it is rendered; without a stream it is kept in memory for get_output()
+    def __init__(self, split_level, stream = None):
+        self._output = PageSink(stream)
         self._split_level = split_level
+    
+    # Writes what is left open at the end of the page
+    def finish(self) -> None:
+        pass
      
     def get_output(self) -> str:
-        return self.PARAGRAPH_SEPARATOR.join(self._output)
+        return self._output.getvalue()
 
     def add(self, content: document.Content) -> None:
+        output = self._output
+        output.separate(self.PARAGRAPH_SEPARATOR)
+        fragments = output.fragments
         match content:
             case document.Paragraph():
-                result = self._add_paragraph(content, True)
+                output.append(self._add_paragraph(content, True))
             case document.List():
-                result = self._add_list(content)
+                self._write_list(output, content, 0)
             case document.DefinitionList():
-                result = self._add_definition_list(content)
+                self._write_definition_list(output, content)
             case document.Table():
-                result = self._add_table(content)
+                self._write_table(output, content)
             case document.Image():
-                result = self._add_image(content)
+                self._write_image(output, content)
             case document.ToC():
-                result = self._add_toc(content)
+                self._write_toc(output, content)
             case document.NavBar():
-                result = self._add_nav_bar(content)
+                self._write_nav_bar(output, content)
             case _:
                 assert False
-        assert result, content
-        self._output.append(result)
+        assert output.fragments > fragments, content
     
     # Methods to add document parts
     def add_header(self, header: document.Header) -> None:
-        self._output.append(self._add_header(header))
+        self._add_block(self._add_header(header))
+    
+    def _add_block(self, text):
+        self._output.separate(self.PARAGRAPH_SEPARATOR)
+        self._output.append(text)
     
     def _add_header(self, header):
         # Promote the file-level header
@@ -65,20 +121,21 @@ class MarkdownWriter:
         return "#" * promoted + " " + self._add_paragraph(header, False)
       
     def _add_paragraph(self, paragraph, write_anchor):
-        result = ""
+        output = []
         if write_anchor and paragraph.bookmarks:
             assert len(paragraph.bookmarks) == 1
             anchor_name = paragraph.bookmarks[0].split("#")[1]
-            result += f'<a name="{anchor_name}"></a>\n'
+            output.append(f'<a name="{anchor_name}"></a>\n')
         if paragraph.grayed_out:
-            result += "> "
-        return result + self._add_spans(paragraph.spans)
+            output.append("> ")
+        output.append(self._add_spans(paragraph.spans))
+        return "".join(output)
         
     # List
-    def _add_list(self, l, offset = 0):
+    # Appends the list's lines to the output, nested lists included
+    def _write_list(self, output, l, offset):
         prefix = " " * offset
         index = 1
-        result = ""
         # Differentiate between bulleted and numbered lists
         match l.kind:
             case document.ListStyle.BULLET:
@@ -93,15 +150,14 @@ class MarkdownWriter:
         for i in l.items:
             match i:
                 case document.Paragraph():
-                    result += (prefix + method(index))
-                    result += self._add_paragraph(i, True)
-                    result += "\n"
+                    output.append(prefix + method(index))
+                    output.append(self._add_paragraph(i, True))
+                    output.append("\n")
                 case document.List():
-                    result += self._add_list(i, offset)
+                    self._write_list(output, i, offset)
                 case _:
                     assert False
             index += 1
-        return result
     
     @staticmethod
     def _make_list_bullet(index):
@@ -113,22 +169,20 @@ class MarkdownWriter:
         return f"{str(index)+'.':<4}"
     
     # Definition List
-    def _add_definition_list(self, dl):
-        output = [f'{self._add_spans(i[0].spans)}\n: {self._add_spans(i[1].spans)}' for i in dl.items]
-        return self.PARAGRAPH_SEPARATOR.join(output)
+    def _write_definition_list(self, output, dl):
+        for i in dl.items:
+            output.append_line(f'{self._add_spans(i[0].spans)}\n: {self._add_spans(i[1].spans)}', self.PARAGRAPH_SEPARATOR)
 
     # Table
-    def _add_table(self, table):
+    def _write_table(self, output, table):
         # Add table header
         assert table.is_valid()
-        output = []
-        output.append(self._make_table_row(table.rows[0]))
+        output.append_line(self._make_table_row(table.rows[0]))
         if len(table.rows) > 1:
-            output.append(self._make_table_separator(table.num_columns))
+            output.append_line(self._make_table_separator(table.num_columns))
         # Add the content
         for r in range(1, len(table.rows)):
-            output.append(self._make_table_row(table.rows[r]))
-        return "\n".join(output)
+            output.append_line(self._make_table_row(table.rows[r]))
     
     def _make_table_row(self, row):
         output = ["|",]
@@ -146,21 +200,19 @@ class MarkdownWriter:
         return " ".join(output)
 
     # Image
-    def _add_image(self, image):
+    def _write_image(self, output, image):
         assert image.data.link
         assert image.scale <= 1
-        return self._make_image_html(image.data, self._make_image_presentation(image.data), image.scale, image.caption)
+        self._write_image_html(output, image.data, self._make_image_presentation(image.data), image.scale, image.caption)
         
-    def _make_image_html(self, image, presentation, scale, caption):
-        output = []
-        output.append('<div align="center">')
-        output.append(f'<a href="{self._escape_link(image.original)}">')
-        output.append(f'<img src="{self._escape_link(image.link)}" alt="{presentation}" loading="lazy" width={scale:.0%}/>')
-        output.append('</a>')
+    def _write_image_html(self, output, image, presentation, scale, caption):
+        output.append_line('<div align="center">')
+        output.append_line(f'<a href="{self._escape_link(image.original)}">')
+        output.append_line(f'<img src="{self._escape_link(image.link)}" alt="{presentation}" loading="lazy" width={scale:.0%}/>')
+        output.append_line('</a>')
         if caption:
-            output.append("\n" + self._add_paragraph(document.Paragraph(caption), True) + "\n")
-        output.append('</div>')
-        return "\n".join(output)
+            output.append_line("\n" + self._add_paragraph(document.Paragraph(caption), True) + "\n")
+        output.append_line('</div>')
     
     def _make_image_presentation(self, image_data):
         presentation = None
@@ -171,19 +223,17 @@ class MarkdownWriter:
         return presentation
     
     # Table of Contents
-    def _add_toc(self, toc):
-        output = []
+    def _write_toc(self, output, toc):
         for i in toc.items:
             assert i.level > 0
             assert i.name
             assert i.link
             if i.level > 1:
-                output.append("  " * (i.level - 2) + "- " + f"[{i.name}]({i.link})")
+                output.append_line("  " * (i.level - 2) + "- " + f"[{i.name}]({i.link})")
             else:        
-                output.append(f"\n### [{i.name}]({i.link})\n")
-        return "\n".join(output)
+                output.append_line(f"\n### [{i.name}]({i.link})\n")
     
-    def _add_nav_bar(self, navbar):
+    def _write_nav_bar(self, output, navbar):
         if navbar.prev or navbar.next or navbar.up:
             links = []
             # Prev
@@ -209,9 +259,8 @@ class MarkdownWriter:
             else:
                 links.append(None)
             # Output
-            return self._make_table_row(links) + "\n" + self._make_table_separator(3)
-        else:
-            return ""
+            output.append_line(self._make_table_row(links))
+            output.append_line(self._make_table_separator(3))
     
     def _add_spans(self, spans):
         output = []
@@ -254,6 +303,27 @@ class MarkdownWriter:
         return f'<span style="color:{self._color_names[color]}">'
     
     def _change_style(self, old, new, old_link, new_link, add_spaces):
+        if old is new and old_link == new_link:
+            return " " * add_spaces
+        # Styles depend on the links only through their presence and borders
+        link_changed = old_link != new_link
+        key = (old, new, bool(old_link), bool(new_link), link_changed)
+        transition = self._transitions.get(key)
+        if transition is None:
+            transition = self._transitions[key] = self._make_transition(old, new, old_link, new_link)
+        close_markup, open_markup = transition
+        output = [close_markup,]
+        if old_link and link_changed:
+            output.append(self._close_link(old_link))
+        # Insert whitespaces which we move from inside the tags
+        output.append(" " * add_spaces)
+        if new_link and link_changed:
+            output.append(self._open_link(new_link))
+        output.append(open_markup)
+        return "".join(output)
+    
+    # Returns the markup to close the old style and to open the new one
+    def _make_transition(self, old, new, old_link, new_link):
         output = []
         old_color = self._get_color_id(old.color)
         new_color = self._get_color_id(new.color)
@@ -275,13 +345,9 @@ class MarkdownWriter:
                 output.append("*")
             if old.strikethrough and not new.strikethrough:
                 output.append("~")
-        if old_link and old_link != new_link:
-            output.append(self._close_link(old_link))
-        # Insert whitespaces which we move from inside the tags
-        output.append(" " * add_spaces)
+        close_markup = "".join(output)
+        output = []
         # Open the new style
-        if new_link and new_link != old_link:
-            output.append(self._open_link(new_link))
         if old_link != new_link:
             # A style cannot cross a link's border - reload
             output.extend(self._open_style(new_color, new_underline, new.bold, new.italic, new.strikethrough))
@@ -297,8 +363,7 @@ class MarkdownWriter:
                 output.append("<ins>")
             if new_color and new_color != old_color:
                 output.append(f'<span {self._make_color_style(new_color)}>')
-        # Merge
-        return "".join(output)
+        return close_markup, "".join(output)
     
     @staticmethod
     def _close_style(color, underline, bold, italic, strikethrough):
@@ -345,12 +410,13 @@ class MarkdownWriter:
     
     @staticmethod
     def _escape_text(text):
-        output = []
-        for l in text:
-            if l in "\\`*_~(){}[]<>#+-.!|":
-                output.append("\\")
-            output.append(l)
-        return "".join(output)
+        # Most of the text has nothing to escape
+        if not _special_characters_regexp.search(text):
+            return text
+        for c, escaped in _escapes:
+            if c in text:
+                text = text.replace(c, escaped)
+        return text
     
     @staticmethod
     def _escape_link(link):
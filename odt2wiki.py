@@ -6,21 +6,29 @@ from argparse import ArgumentParser
 from zipfile import ZipFile
 from tempfile import TemporaryDirectory
 import os.path
+import sys
+import time
+import pickle
+import traceback
+import multiprocessing
 import functools
 import importlib
 
 import odt_tools
 import odt_parser
 import document
+import cache
 import plugins
-import github_writer, hugo_writer
+import md_writer, github_writer, hugo_writer
 import image_matcher
 import svg_tools
+from output_folder import OutputFolder
 from analytics import duplicates
 
 
 TEXT_XML_FILE_NAME = "content.xml"
 STYLES_XML_FILE_NAME = "styles.xml"
+WATCH_INTERVAL = 1.0    # Seconds between checks for changes in the input files
 
 
 def _print_dict_tree(key, tree, level):
@@ -63,11 +71,7 @@ def extract_text(content, dest_path):
     with open(dest_path, "x") as output:
         output.write(visitor.results())
 
-def analyze(archive, content, styles, split_level, images_folder, remote_images, customization, analytics):
-    # Parse the input file
-    visitor = odt_parser.FullVisitor()
-    visitor.preload_styles(styles)
-    visitor.traverse(content)
+def analyze(archive, visitor, split_level, images_folder, remote_images, fast_matching, hash_matching, customization, analytics, cache_dir, jobs):
     # Process the content
     doc = document.Document(None, split_level, plugins.Strategy(), customization)
     visitor.fill_document(doc)
@@ -77,7 +81,7 @@ def analyze(archive, content, styles, split_level, images_folder, remote_images,
     # Process images if needed
     if images_folder:
         with TemporaryDirectory() as tempdirname:
-            _process_images(doc, archive, tempdirname, images_folder, remote_images, False, customization)
+            _process_images(doc, archive, tempdirname, OutputFolder(tempdirname), images_folder, remote_images, False, fast_matching, hash_matching, False, cache_dir, jobs, customization)
     # Run the analyitcs
     print()
     result = analytics.make(doc.root(), customization)
@@ -86,13 +90,50 @@ def analyze(archive, content, styles, split_level, images_folder, remote_images,
 
 # Main methods        
 
-def _create_document(content, styles, dest_path, split_level, strategy, customization, landing_name):
-    # Parse the input file
+def _parse_document(archive, stream):
     visitor = odt_parser.FullVisitor()
-    visitor.preload_styles(styles)
-    visitor.traverse(content)
+    visitor.preload_styles(odt_tools.parse(archive.read(STYLES_XML_FILE_NAME)))
+    if stream:
+        # Read the XML right from the archive and discard it as soon as it is converted
+        with archive.open(TEXT_XML_FILE_NAME) as source:
+            visitor.stream(source)
+    else:
+        visitor.traverse(odt_tools.parse(archive.read(TEXT_XML_FILE_NAME)))
+    return visitor
+
+def _load_document(archive, input_path, stream, cache_dir):
+    if not cache_dir:
+        return _parse_document(archive, stream)
+    # The parsed document depends on the XML files and on the code which parses them
+    key = (cache.hash_members(archive, TEXT_XML_FILE_NAME, STYLES_XML_FILE_NAME), 
+           cache.hash_modules(odt_parser, odt_tools, document))
+    storage = cache.Cache(cache_dir, "document-" + cache.hash_string(os.path.abspath(input_path)))
+    visitor = storage.load(key)
+    if visitor:
+        print(f"Loaded the parsed document from the cache in {cache_dir}")
+    else:
+        visitor = _parse_document(archive, stream)
+        storage.store(key, visitor)
+    return visitor
+
+def _get_render_version():
+    # Rendered pages depend on the code of the writers and of the customization
+    custom_modules = [m for n, m in sorted(sys.modules.items()) if n.startswith("custom.")]
+    return cache.hash_modules(document, plugins, md_writer, github_writer, hugo_writer, *custom_modules)
+
+def _open_render_cache(cache_dir, input_path, output_format):
+    if not cache_dir:
+        return None
+    return cache.FileCache(cache_dir, f"pages-{output_format}-{cache.hash_string(os.path.abspath(input_path))}", _get_render_version())
+
+def _close_render_cache(renders):
+    if renders:
+        print(f"Pages reused from the cache: {renders.hits}, rendered: {renders.misses}")
+        renders.prune()
+
+def _create_document(visitor, dest_path, output, split_level, strategy, customization, landing_name):
     # Process the content
-    doc = document.Document(dest_path, split_level, strategy, customization)
+    doc = document.Document(dest_path, split_level, strategy, customization, output)
     visitor.fill_document(doc)
     doc.finalize()
     # Add the landing page
@@ -118,7 +159,7 @@ def _replace_image_dimensions_with_svg(image):
         print(f"Exception {e} while processing {image.link}")
         raise
 
-def _process_images(doc, archive, dest_path, images_folder, remote_image_path, use_svg, customization = None):
+def _process_images(doc, archive, dest_path, output, images_folder, remote_image_path, use_svg, fast_matching, hash_matching, hash_names, cache_dir, jobs, customization = None, matches = None):
     external_images = {}
     internal_images = {}
     extras = {}
@@ -128,7 +169,7 @@ def _process_images(doc, archive, dest_path, images_folder, remote_image_path, u
             exit(1)
         full_local_path = os.path.expanduser(images_folder)
         # Get image dimensions and do match images between the local image folder and the input ODT archive
-        matched, unmatched, all_locals = image_matcher.match_images(archive, full_local_path)
+        matched, unmatched, all_locals = matches if matches else image_matcher.match_images(archive, full_local_path, cache_dir, jobs, fast_matching, hash_matching)
         # Replace PNG image dimensions with those of SVG images if we are going to use them instead
         if use_svg:
             for v in matched.values():
@@ -149,10 +190,10 @@ def _process_images(doc, archive, dest_path, images_folder, remote_image_path, u
         external_images = matched
         # Extract images from the input ODT which we could not match to anything in our local image folder
         if unmatched:
-            image_matcher.extract_images(archive, dest_path, unmatched)
+            image_matcher.extract_images(archive, dest_path, unmatched, output, hash_names)
             internal_images = unmatched
     else:
-        internal_images = image_matcher.extract_all_images(archive, dest_path)
+        internal_images = image_matcher.extract_all_images(archive, dest_path, output, hash_names)
     # Use the images
     doc.link_images(external_images, internal_images)
     if customization:
@@ -160,63 +201,207 @@ def _process_images(doc, archive, dest_path, images_folder, remote_image_path, u
 
 
 def convert_to_github_markdown( archive,
-                                content, 
-                                styles, 
+                                visitor, 
                                 dest_path, 
                                 collapse_level, 
                                 split_level, 
                                 images_folder, 
                                 remote_image_path,
                                 use_svg,
-                                customization):
+                                fast_matching,
+                                hash_matching,
+                                hash_names,
+                                customization,
+                                renders,
+                                sync,
+                                jobs,
+                                cache_dir,
+                                matches = None):
     # Set up
     strategy = github_writer.GithubStrategy()
-    doc, index = _create_document(content, styles, dest_path, split_level, strategy, customization, "Home")
+    output = OutputFolder(dest_path, sync)
+    doc, index = _create_document(visitor, dest_path, output, split_level, strategy, customization, "Home")
     side_toc = document.Section.create("_Sidebar", [index,], dest_path) if index else None
     # Check for duplicate file names as the GitHub wiki ignores paths
     dups = duplicates.HasDuplicateChapters().make(doc.root())
     assert not dups, dups
     # Map pictires inside the ODT to picture files in the destination folder
-    _process_images(doc, archive, dest_path, images_folder, remote_image_path, use_svg)
+    _process_images(doc, archive, dest_path, output, images_folder, remote_image_path, use_svg, fast_matching, hash_matching, hash_names, cache_dir, jobs, None, matches)
     # Convert to markdown
     doc.crosslink()
     github_writer.GithubMarkdownWriter.set_customization(customization)
-    doc.dump(functools.partial(github_writer.GithubMarkdownWriter, collapse_level=collapse_level))
+    doc.dump(functools.partial(github_writer.GithubMarkdownWriter, collapse_level=collapse_level), renders, jobs)
     if side_toc:
-        side_toc.dump(functools.partial(github_writer.GithubMarkdownWriter, toc_collapse_level=1))   # Collapse book parts in the ToC
+        side_toc.dump(functools.partial(github_writer.GithubMarkdownWriter, toc_collapse_level=1), renders)   # Collapse book parts in the ToC
+    _close_render_cache(renders)
+    output.finalize()
     print(f"GitHub markdown created in {dest_path}")
 
 def convert_to_hugo_markdown(   archive,
-                                content, 
-                                styles, 
+                                visitor, 
                                 dest_path, 
                                 collapse_level, 
                                 split_level, 
                                 images_folder, 
                                 remote_image_path,
                                 use_svg,
-                                customization):
+                                fast_matching,
+                                hash_matching,
+                                hash_names,
+                                customization,
+                                renders,
+                                sync,
+                                jobs,
+                                cache_dir,
+                                matches = None):
     assert not collapse_level, "Not implemented"
     # Set up
     strategy = hugo_writer.HugoStrategy()
-    doc, _ = _create_document(content, styles, dest_path, split_level, strategy, customization, 
+    output = OutputFolder(dest_path, sync)
+    doc, _ = _create_document(visitor, dest_path, output, split_level, strategy, customization, 
             customization.subtitle if customization.subtitle else "Table of Contents")
     # Map pictires inside the ODT to picture files in the destination folder
-    _process_images(doc, archive, dest_path, images_folder, remote_image_path, use_svg, customization)
+    _process_images(doc, archive, dest_path, output, images_folder, remote_image_path, use_svg, fast_matching, hash_matching, hash_names, cache_dir, jobs, customization, matches)
     # Convert to markdown
     doc.crosslink()
     hugo_writer.HugoMarkdownWriter.set_customization(customization)
-    doc.dump(hugo_writer.HugoMarkdownWriter)
+    doc.dump(hugo_writer.HugoMarkdownWriter, renders, jobs)
+    _close_render_cache(renders)
+    output.finalize()
     print(f"Hugo markdown created in {dest_path}")
 
 
+def _create_customization(args):
+    if args.customize:
+        return importlib.import_module("custom." + args.customize).export(args.convert)
+    else:
+        return plugins.Customization()
+
+def _convert_to_markdown(args, archive, visitor, dest_path, customization, renders, sync, cache_dir, matches = None):
+    match args.convert:
+        case "github":
+            print(f"Converting to GitHub markdown in {args.output}")
+            converter = convert_to_github_markdown
+        case "hugo":
+            print(f"Converting to Hugo markdown in {args.output}")
+            converter = convert_to_hugo_markdown
+        case _:
+            assert False
+    converter(  archive,
+                visitor, 
+                dest_path,
+                args.collapse_level, 
+                args.split_level,
+                args.images_folder,
+                args.remote_images,
+                args.use_svg,
+                args.fast_matching,
+                args.hash_matching,
+                args.hash_names,
+                customization,
+                renders,
+                sync,
+                args.jobs,
+                cache_dir,
+                matches)
+
+
+# Watch mode: keeps results of the slow stages in memory and reconverts the document whenever its files change
+class _Watcher:
+    def __init__(self, args, dest_path, cache_dir):
+        self._args = args
+        self._dest_path = dest_path
+        self._cache_dir = cache_dir
+        self._input_path = os.path.expanduser(args.input)
+        self._images_folder = os.path.expanduser(args.images_folder) if args.images_folder else None
+        self._document_key = None
+        self._document = None       # Pickled, as the conversion modifies the parsed content
+        self._matches_key = None
+        self._matches = None        # Pickled, as the conversion modifies image data
+        self._renders = cache.MemoryCache(_get_render_version())
+        
+    def run(self):
+        print(f"Watching {self._args.input} for changes. Press Ctrl+C to stop.")
+        state = None
+        unavailable = False
+        try:
+            while True:
+                # The ODT may be missing for a moment while it is being saved, images may be deleted while we walk the folder
+                try:
+                    new_state = self._get_state()
+                    unavailable = False
+                except OSError as e:
+                    if not unavailable:
+                        print(f"Cannot check the input files, waiting for them: {e}")
+                    unavailable = True
+                    time.sleep(WATCH_INTERVAL)
+                    continue
+                if new_state != state:
+                    state = new_state
+                    try:
+                        self._convert(state[1])
+                    except Exception:
+                        traceback.print_exc()
+                        print("Conversion failed, waiting for the next change")
+                time.sleep(WATCH_INTERVAL)
+        except KeyboardInterrupt:
+            print()
+            print("Stopped watching")
+    
+    def _get_state(self):
+        stat = os.stat(self._input_path)
+        local_images = {}
+        if self._images_folder:
+            for path, _, files in os.walk(self._images_folder):
+                for f in files:
+                    filename = os.path.join(path, f)
+                    image_stat = os.stat(filename)
+                    local_images[filename] = (image_stat.st_mtime_ns, image_stat.st_size)
+        return (stat.st_mtime_ns, stat.st_size), local_images
+    
+    def _convert(self, local_images):
+        start = time.perf_counter()
+        with ZipFile(self._input_path) as archive:
+            # Parse the document only if its text has changed
+            document_key = cache.hash_members(archive, TEXT_XML_FILE_NAME, STYLES_XML_FILE_NAME)
+            document_reused = document_key == self._document_key
+            if document_reused:
+                visitor = pickle.loads(self._document)
+            else:
+                visitor = _load_document(archive, self._args.input, self._args.stream, self._cache_dir)
+                self._document = pickle.dumps(visitor, pickle.HIGHEST_PROTOCOL)
+                self._document_key = document_key
+            parsed = time.perf_counter()
+            # Match images only if the images in the document or in the local folder have changed
+            matches = None
+            matches_reused = False
+            if self._images_folder and image_matcher.has_image_matcher:
+                matches_key = ([(i.filename, i.CRC, i.file_size) for i in archive.infolist() if i.filename.startswith(image_matcher.PICTURES_FOLDER)],
+                               local_images)
+                matches_reused = matches_key == self._matches_key
+                if matches_reused:
+                    matches = pickle.loads(self._matches)
+                else:
+                    matches = image_matcher.match_images(archive, self._images_folder, self._cache_dir, self._args.jobs, self._args.fast_matching, self._args.hash_matching)
+                    self._matches = pickle.dumps(matches, pickle.HIGHEST_PROTOCOL)
+                    self._matches_key = matches_key
+            matched = time.perf_counter()
+            # Write the pages which have changed
+            _convert_to_markdown(self._args, archive, visitor, self._dest_path, _create_customization(self._args), self._renders, True, self._cache_dir, matches)
+        done = time.perf_counter()
+        print(f"Reconverted in {done - start:.2f} s: "
+              f"parsing {parsed - start:.2f} s{' (reused)' if document_reused else ''}, "
+              f"images {matched - parsed:.2f} s{' (reused)' if matches_reused else ''}, "
+              f"output {done - matched:.2f} s")
+
+
 def main():
     description = "Convert ODT to wiki markdown. It can split a book into chapters and match images from the document to those on your drive."
     usage = """
-odt2wiki.py <input.odt> --print={files|attrs|tags}
-odt2wiki.py <input.odt> --analyze=<script> [--split=<level>] [--customize=<python_module>] [--images-folder=<folder> [--remote-images={<link>|<folder>}]]
-odt2wiki.py <input.odt> <output.txt> --convert=text
-odt2wiki.py <input.odt> <output_folder> --convert={github|hugo} [--collapse=<level>] [--split=<level>] [--images-folder=<folder> [--remote-images={<link>|<folder>}]] [--customize=<python_module>]"""
+odt2wiki.py <input.odt> --print={files|attrs|tags} [--parser={auto|lxml|stdlib}]
+odt2wiki.py <input.odt> --analyze=<script> [--parser={auto|lxml|stdlib}] [--stream] [--cache-dir=<folder>|--no-cache] [--split=<level>] [--customize=<python_module>] [--images-folder=<folder> [--remote-images={<link>|<folder>}] [--fast-matching] [--hash-matching]]
+odt2wiki.py <input.odt> <output.txt> --convert=text [--parser={auto|lxml|stdlib}]
+odt2wiki.py <input.odt> <output_folder> --convert={github|hugo} [--parser={auto|lxml|stdlib}] [--stream] [--cache-dir=<folder>|--no-cache] [--sync|--watch] [--jobs=<count>] [--collapse=<level>] [--split=<level>] [--images-folder=<folder> [--remote-images={<link>|<folder>}] [--fast-matching] [--hash-matching]] [--hash-names] [--customize=<python_module>]"""
     
     # Set up the CLI arguments
     parser = ArgumentParser(description=description, usage=usage)
@@ -230,30 +415,51 @@ odt2wiki.py <input.odt> <output_folder> --convert={github|hugo} [--collapse=<lev
     group.add_argument("-c", "--convert", choices=("text", "github", "hugo"), help="convert the ODT into a chosen format: %(choices)s")
     group.add_argument("-y", "--analyze", action="store", help="run an analytics script from the 'analytics' folder")
     
+    group = parser.add_argument_group("Options for parsing")
+    group.add_argument("-x", "--parser", choices=odt_tools.PARSERS, default="auto", help="XML backend: %(choices)s (auto prefers lxml if installed)")
+    group.add_argument("-m", "--stream", action="store_true", help="parse the document incrementally to save memory on large files")
+    group.add_argument("--cache-dir", action="store", default=cache.DEFAULT_FOLDER, help="folder to cache the parsed document and rendered pages in (default: %(default)s)")
+    group.add_argument("--no-cache", action="store_true", help="always parse and render the document from scratch")
+    
     group = parser.add_argument_group("Options for markdown conversion")
     group.add_argument("-l", "--collapse-level", action="store", type=int, default=0, help="collapse sections at this outline level")
     group.add_argument("-s", "--split-level", action="store", type=int, default=0, help="split sections into files at this outline level")
     group.add_argument("-i", "--images-folder", action="store", help="local folder with images used throughout the document")
     group.add_argument("-r", "--remote-images", action="store", help="route image requests from wiki to this folder")
     group.add_argument("-v", "--use-svg", action="store_true", help="replace images with SVG from the local folder")
+    group.add_argument("-f", "--fast-matching", action="store_true", help="decode JPEG images at a reduced resolution for matching, which is faster but may leave some images unmatched")
+    group.add_argument("--hash-matching", action="store_true", help="match images whose colors were changed by re-encoding by their perceptual hashes, which may match unrelated plain diagrams")
+    group.add_argument("-n", "--hash-names", action="store_true", help="name pictures extracted from the ODT by the hash of their content, writing identical pictures once")
     group.add_argument("-z", "--customize", action="store", help="custom rules for your document from the 'custom' folder")
+    group.add_argument("-u", "--sync", action="store_true", help="update an existing output folder, rewriting only the changed files")
+    group.add_argument("-w", "--watch", action="store_true", help="keep running and update the output folder whenever the input files change")
+    group.add_argument("-j", "--jobs", action="store", type=int, default=1, help="decode images and render pages in this many processes")
     
     args = parser.parse_args()
     
+    if args.parser == "lxml" and not odt_tools.has_lxml:
+        print("FATAL: The lxml parser requires lxml to be installed\n")
+        exit(1)
+    odt_tools.set_parser(args.parser)
+    
+    assert args.jobs > 0
+    if args.jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("FATAL: Rendering in multiple processes (--jobs) is not supported on this platform\n")
+        exit(1)
+    
     # Run the user's command
     print()
     print(f"Processing ODT archive {args.input}...")
     with ZipFile(os.path.expanduser(args.input)) as archive:
         assert args.input
-        # Process parameters
-        parsed_content = odt_tools.parse(archive.read(TEXT_XML_FILE_NAME))
-        parsed_styles = odt_tools.parse(archive.read(STYLES_XML_FILE_NAME))
         # Run the command
         if args.print:
             if args.output:
                 parser.print_usage()
                 print("Output file is not supported with --print")
                 exit()
+            parsed_content = odt_tools.parse(archive.read(TEXT_XML_FILE_NAME))
+            parsed_styles = odt_tools.parse(archive.read(STYLES_XML_FILE_NAME))
             match args.print:
                 case "files":
                     print("Archive contents:")
@@ -274,21 +480,22 @@ odt2wiki.py <input.odt> <output_folder> --convert={github|hugo} [--collapse=<lev
                     assert False
         else:
             # Process more parameters
-            if args.customize:
-                customization = importlib.import_module("custom." + args.customize).export(args.convert)
-            else:
-                customization = plugins.Customization()
+            customization = _create_customization(args)
+            cache_dir = None if args.no_cache else args.cache_dir
             # Run the command
             if args.analyze:
                 analytics = importlib.import_module("analytics." + args.analyze).export()
                 analyze(archive, 
-                        parsed_content, 
-                        parsed_styles, 
+                        _load_document(archive, args.input, args.stream, cache_dir), 
                         args.split_level, 
                         args.images_folder, 
                         args.remote_images, 
+                        args.fast_matching,
+                        args.hash_matching,
                         customization, 
-                        analytics)
+                        analytics,
+                        cache_dir,
+                        args.jobs)
             else:
                 assert args.convert
                 # Process more parameters
@@ -301,31 +508,19 @@ odt2wiki.py <input.odt> <output_folder> --convert={github|hugo} [--collapse=<lev
                 match args.convert:
                     case "text":
                         print(f"Extracting text from {TEXT_XML_FILE_NAME} to {args.output}")
-                        extract_text(parsed_content, dest_path)
-                    case "github":
-                        print(f"Converting to GitHub markdown in {args.output}")
-                        convert_to_github_markdown( archive,
-                                                    parsed_content, 
-                                                    parsed_styles, 
-                                                    dest_path,
-                                                    args.collapse_level, 
-                                                    args.split_level,
-                                                    args.images_folder,
-                                                    args.remote_images,
-                                                    args.use_svg,
-                                                    customization)
-                    case "hugo":
-                        print(f"Converting to Hugo markdown in {args.output}")
-                        convert_to_hugo_markdown(   archive,
-                                                    parsed_content, 
-                                                    parsed_styles, 
-                                                    dest_path,
-                                                    args.collapse_level, 
-                                                    args.split_level,
-                                                    args.images_folder,
-                                                    args.remote_images,
-                                                    args.use_svg,
-                                                    customization)
+                        extract_text(odt_tools.parse(archive.read(TEXT_XML_FILE_NAME)), dest_path)
+                    case "github" | "hugo":
+                        if args.watch:
+                            _Watcher(args, dest_path, cache_dir).run()
+                        else:
+                            _convert_to_markdown(args, 
+                                                 archive, 
+                                                 _load_document(archive, args.input, args.stream, cache_dir), 
+                                                 dest_path, 
+                                                 customization, 
+                                                 _open_render_cache(cache_dir, args.input, args.convert), 
+                                                 args.sync,
+                                                 cache_dir)
                     case _:
                         assert False
     print()
@@ -3,12 +3,21 @@
 from collections import defaultdict
 from xml.etree.ElementTree import Element
 
-from odt_tools import extract
+from odt_tools import extract, iterparse, Dispatcher
 import document
 import exceptions
 
+
+# Normalized styles are shared among spans: there are only a few dozens of distinct styles in a document
+_normalized_styles = {}
+# Converted colors by their ODT strings. Different strings may convert to the same color, e.g. "#ABCDEF" and "#abcdef".
+_converted_colors = {}
+
+
 # Data classes
 class _Style:
+    __slots__ = ("bold", "italic", "underline", "strikethrough", "colored_background", "color", "centered")
+    
     def __init__(self):
         self.bold = None
         self.italic = None
@@ -36,7 +45,16 @@ class _Style:
         return self
     
     def normalize(self):
-        return document.Style(self.bold, self.italic, self.underline, self.strikethrough, self._convert_color(self.color))
+        color = _converted_colors.get(self.color)
+        if color is None:
+            color = _converted_colors[self.color] = self._convert_color(self.color)
+        # Key by the converted color for the equal styles to be the same object
+        key = (self.bold, self.italic, self.underline, self.strikethrough, color)
+        style = _normalized_styles.get(key)
+        if style is None:
+            style = document.Style(self.bold, self.italic, self.underline, self.strikethrough, color)
+            _normalized_styles[key] = style
+        return style
     
     @staticmethod
     def _convert_color(color):
@@ -44,6 +62,8 @@ class _Style:
         
 
 class _Span:
+    __slots__ = ("text", "style", "link")
+    
     def __init__(self, text, style):
         self.text = text
         self.style = style
@@ -92,19 +112,49 @@ class FullVisitor():
                     assert extract(text.tag) == "text"
                     self._traverse_text(text)
                 except:
-                    print("EXCEPTION while parsing the input document.")
-                    print("The last successfully parsed elements were:")
-                    for i in reversed(self._content):
-                        meta = type(i)
-                        print(meta.__name__)
-                        if meta == document.Header:
-                            print(i.to_string())
-                        elif meta == document.Paragraph:
-                            print(i.to_string())
-                            break
+                    self._print_last_parsed()
                     raise
         self._rescale_images()
     
+    # Parses content.xml from a file-like object without keeping the whole XML tree in memory
+    def stream(self, source) -> None:
+        depth = 0
+        root = None
+        body = None
+        text = None
+        try:
+            for event, elem in iterparse(source, events=("start", "end")):
+                if event == "start":
+                    if depth == 0:
+                        root = elem
+                        assert extract(root.tag) == "document-content"
+                    elif depth == 1 and extract(elem.tag) == "body":
+                        body = elem
+                    elif depth == 2 and body is not None:
+                        assert text is None
+                        assert extract(elem.tag) == "text"
+                        text = elem
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 3 and text is not None:
+                    # A top-level element of the text has been closed - convert it and free its subtree
+                    self._traverse_text_child(elem)
+                    text.remove(elem)
+                elif depth == 1:
+                    child_tag = extract(elem.tag)
+                    if child_tag == "automatic-styles":
+                        self._traverse_styles(elem)
+                    elif child_tag == "body":
+                        assert text is not None
+                        body = None
+                    root.remove(elem)
+        except:
+            if text is not None:
+                self._print_last_parsed()
+            raise
+        self._rescale_images()
+    
     # _Style extraction
     def _traverse_styles(self, styles):
         assert not styles.attrib
@@ -120,20 +170,16 @@ class FullVisitor():
     # Information retrieval
     def _traverse_text(self, text):
         for child in text:
-            child_tag = extract(child.tag)
-            match child_tag:
-                case "h":
-                    self._content.append(self._process_h(child))
-                case "p":
-                    content = self._process_p(child)
-                    if content:
-                        self._content.append(content)
-                case "list":
-                    self._content.append(self._process_list(child))
-                case "table":
-                    self._content.append(self._process_table(child))
-                case _:
-                    self._unhandled_tags.add(child_tag)
+            self._traverse_text_child(child)
+    
+    def _traverse_text_child(self, child):
+        handler = self._text_handlers[child.tag]
+        if handler:
+            content = handler(self, child)
+            if content:
+                self._content.append(content)
+        else:
+            self._unhandled_tags.add(extract(child.tag))
     
     def _rescale_images(self):
         # Translate image dimensions to relative scale
@@ -165,16 +211,11 @@ class FullVisitor():
         if header.text:
             header.spans.append(_Span(header.text, style))
         for child in header:
-            child_tag = extract(child.tag)
-            match child_tag:
-                case "a":
-                    span = self._process_a(child)
-                    span.style |= style
-                    output.spans.append(span)
-                case "bookmark":
-                    output.bookmarks.append(self._process_bookmark(child))
-                case _:
-                    self._unhandled_tags.add(child_tag)
+            handler = self._header_handlers[child.tag]
+            if handler:
+                handler(self, output, child, style)
+            else:
+                self._unhandled_tags.add(extract(child.tag))
             if child.tail:
                 output.spans.append(_Span(child.tail, style))
         # Commit
@@ -198,30 +239,14 @@ class FullVisitor():
         if paragraph.text:
             output.spans.append(_Span(paragraph.text, style))
         for child in paragraph:
-            child_tag = extract(child.tag)
-            match child_tag:
-                case "a":
-                    span = self._process_a(child)
-                    span.style |= style
-                    output.grayed_out = output.grayed_out or span.style.colored_background
-                    output.spans.append(span)
-                case "span":
-                    span = self._process_span(child)
-                    if span:
-                        span.style |= style
-                        output.grayed_out = output.grayed_out or span.style.colored_background
-                        output.spans.append(span)
-                case "bookmark" | "bookmark-end":
-                    output.bookmarks.append(self._process_bookmark(child))
-                case "frame":
+            handler = self._paragraph_handlers[child.tag]
+            if handler:
+                result = handler(self, output, child, style)
+                if result:
                     assert not image
-                    image = self._process_frame(child)
-                case "tab":
-                    output.spans.append(_Span("\t", style))
-                case "s":
-                    output.spans.append(_Span(self._process_s(child), style))
-                case _:
-                    self._unhandled_tags.add(child_tag)
+                    image = result
+            else:
+                self._unhandled_tags.add(extract(child.tag))
             if child.tail:
                 output.spans.append(_Span(child.tail, style))
         # Commit
@@ -483,6 +508,49 @@ Paragraph text: '{output.to_string()}'.""")
         # Results
         return document.Image(link, width)
             
+    # Handlers for children of headers and paragraphs. Only images are returned, the rest goes to the output paragraph.
+    def _on_header_a(self, output, a, style):
+        span = self._process_a(a)
+        span.style |= style
+        output.spans.append(span)
+    
+    def _on_paragraph_a(self, output, a, style):
+        span = self._process_a(a)
+        span.style |= style
+        output.grayed_out = output.grayed_out or span.style.colored_background
+        output.spans.append(span)
+    
+    def _on_span(self, output, span, style):
+        span = self._process_span(span)
+        if span:
+            span.style |= style
+            output.grayed_out = output.grayed_out or span.style.colored_background
+            output.spans.append(span)
+    
+    def _on_bookmark(self, output, bookmark, style):
+        output.bookmarks.append(self._process_bookmark(bookmark))
+    
+    def _on_frame(self, output, frame, style):
+        return self._process_frame(frame)
+    
+    def _on_tab(self, output, tab, style):
+        output.spans.append(_Span("\t", style))
+    
+    def _on_s(self, output, s, style):
+        output.spans.append(_Span(self._process_s(s), style))
+            
+    def _print_last_parsed(self):
+        print("EXCEPTION while parsing the input document.")
+        print("The last successfully parsed elements were:")
+        for i in reversed(self._content):
+            meta = type(i)
+            print(meta.__name__)
+            if meta == document.Header:
+                print(i.to_string())
+            elif meta == document.Paragraph:
+                print(i.to_string())
+                break
+            
     def _print_warnings(self):
         print()
         print("Unhandled tags: " + ", ".join(sorted(self._unhandled_tags)))
@@ -497,7 +565,7 @@ Paragraph text: '{output.to_string()}'.""")
         output = []
         for s in spans:
             converted_style = s.style.normalize()
-            if len(output) and output[-1].style == converted_style:
+            if len(output) and output[-1].style is converted_style:
                 output[-1].text += s.text
                 if s.link:
                     if not output[-1].link:
@@ -506,4 +574,25 @@ Paragraph text: '{output.to_string()}'.""")
                         assert output[-1].link == s.link
             else:
                 output.append(document.Span(s.text, converted_style, s.link))
-        return output
\ No newline at end of file
+        return output
+    
+    # Dispatch tables
+    _text_handlers = Dispatcher({
+        "h": _process_h,
+        "p": _process_p,
+        "list": _process_list,
+        "table": _process_table
+    })
+    _header_handlers = Dispatcher({
+        "a": _on_header_a,
+        "bookmark": _on_bookmark
+    })
+    _paragraph_handlers = Dispatcher({
+        "a": _on_paragraph_a,
+        "span": _on_span,
+        "bookmark": _on_bookmark,
+        "bookmark-end": _on_bookmark,
+        "frame": _on_frame,
+        "tab": _on_tab,
+        "s": _on_s
+    })
@@ -1,43 +1,102 @@
 "Tools for investigating ODT files"
 
+has_lxml = True
+
+try:
+    import lxml.etree
+except ModuleNotFoundError:
+    has_lxml = False
+
 import xml.etree.ElementTree
 from collections import defaultdict
 
 
+PARSERS = ("auto", "lxml", "stdlib")
+
+_use_lxml = has_lxml
+
+
+# Local names of Clark-notation tags and attributes, e.g. "{urn:oasis:names:tc:opendocument:xmlns:text:1.0}p" -> "p"
+class _LocalNames(dict):
+    def __missing__(self, name):
+        local_name = self[name] = name.split("}")[1]
+        return local_name
+
+_local_names = _LocalNames()
+
+
 # Remove namespace
 def extract(name):
-    return name.split("}")[1]
+    return _local_names[name]
+
+
+# A dispatch table from Clark-notation tags to handlers which are registered by local names. 
+# Each tag is resolved only once, unknown tags map to None.
+class Dispatcher(dict):
+    def __init__(self, handlers):
+        super().__init__()
+        self._handlers = handlers
+        
+    def __missing__(self, tag):
+        handler = self[tag] = self._handlers.get(extract(tag))
+        return handler
+
+
+# Choose the XML backend: "auto" prefers lxml if it is installed
+def set_parser(name):
+    global _use_lxml
+    assert name in PARSERS
+    assert has_lxml or name != "lxml"
+    _use_lxml = has_lxml and name != "stdlib"
+
+def parser_name():
+    return "lxml" if _use_lxml else "stdlib"
 
 
 # Parse XML
 def parse(content):
-    return xml.etree.ElementTree.fromstring(content)
+    if _use_lxml:
+        return lxml.etree.fromstring(content, lxml.etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True))
+    else:
+        return xml.etree.ElementTree.fromstring(content)
 
 
-# Collects unique tags and their content from the entire XML treee
+# Parse XML from a file-like object, yielding (event, element) pairs
+def iterparse(source, events):
+    if _use_lxml:
+        return lxml.etree.iterparse(source, events=events, remove_comments=True, remove_pis=True, huge_tree=True)
+    else:
+        return xml.etree.ElementTree.iterparse(source, events)
+
+
+# Collects unique tags and their content from the entire XML treee.
+# The names are collected in the Clark notation and converted through the shared table only once each, in results().
 class UniqueTagsVisitor:
+    TEXT = "+text"
+    
     def __init__(self):
         self._tags = defaultdict(set)
         
     def traverse(self, element):
         # Remember the tag and the element's attributes
-        tag = extract(element.tag)
-        attrs = self._tags[tag]
-        for key in element.attrib.keys():
-            attrs.add(extract(key))
+        attrs = self._tags[element.tag]
+        attrs.update(element.attrib.keys())
         if element.text:
-            attrs.add("+text")
+            attrs.add(self.TEXT)
         # Traverse children
         for child in element:
             self.traverse(child)
             if child.tail:
-                attrs.add("+text")
+                attrs.add(self.TEXT)
     
     def results(self):
-        return self._tags
+        tags = defaultdict(set)
+        for tag, attrs in self._tags.items():
+            tags[_local_names[tag]].update([a if a == self.TEXT else _local_names[a] for a in attrs])
+        return tags
     
 
-# Collects unique tags into a tree of dictionaries
+# Collects unique tags into a tree of dictionaries, keyed by Clark-notation names until results()
 class TagsTreeVisitor:
     def __init__(self):
         self._tree = {}
@@ -46,17 +105,22 @@ class TagsTreeVisitor:
         self._recurse(self._tree, root)
     
     def results(self):
-        return self._tree
+        tree = {}
+        self._convert(self._tree, tree)
+        return tree
 
     @staticmethod
     def _recurse(dic, element):
-        # Make sure we remeber the current element's tag
-        tag = extract(element.tag)
-        if tag not in dic:
-            dic[tag] = {}
-        # Visit the current element's children
+        # Make sure we remeber the current element's tag, then visit its children
+        children = dic.setdefault(element.tag, {})
         for child in element:
-            TagsTreeVisitor._recurse(dic[tag], child)
+            TagsTreeVisitor._recurse(children, child)
+    
+    # Replaces the Clark-notation names with the local ones, merging the subtrees of tags from different namespaces
+    @staticmethod
+    def _convert(tree, result):
+        for tag, children in tree.items():
+            TagsTreeVisitor._convert(children, result.setdefault(_local_names[tag], {}))
 
 
 # Plain text extraction
@@ -64,24 +128,6 @@ class TextVisitor():
     def __init__(self):
         self._content = []
         self._unhandled = set()
-        # Dispatch tables
-        self._text_child_handlers = {
-            "p": self._on_p,
-            "h": self._on_h,
-            "list": self._on_list,
-            "table": self._on_table
-        }
-        self._paragraph_child_handlers = {
-            "a": self._on_a,
-            "span": self._on_span,
-            "frame": self._on_frame,
-            "s": self._on_s,
-            "tab": self._on_tab
-        }
-        self._list_item_handlers = {
-            "p": self._on_p,
-            "list": self._on_list,
-        }
         
     def results(self):
         print("Unhandles tags: " + ", ".join(sorted(self._unhandled)))
@@ -100,12 +146,11 @@ class TextVisitor():
     
     def _traverse_text(self, text):
         for child in text:
-            tag = extract(child.tag)
-            handler = self._text_child_handlers.get(tag)
+            handler = self._text_child_handlers[child.tag]
             if handler:
-                self._content.append(handler(child))
+                self._content.append(handler(self, child))
             else:
-                self._unhandled.add(tag)
+                self._unhandled.add(extract(child.tag))
     
     # Top-level elements
     def _on_h(self, h):
@@ -118,12 +163,11 @@ class TextVisitor():
             paragraph.append(p.text)
         # Add child elements
         for child in p:
-            tag = extract(child.tag)
-            handler = self._paragraph_child_handlers.get(tag)
+            handler = self._paragraph_child_handlers[child.tag]
             if handler:
                 handler(paragraph, child)
             else:
-                self._unhandled.add(tag)
+                self._unhandled.add(extract(child.tag))
             # Add any text found between this and the following element
             if child.tail:
                 paragraph.append(child.tail)
@@ -163,10 +207,9 @@ class TextVisitor():
             tag = extract(child.tag)
             assert tag == "list-item"
             for grandchild in child:
-                grandtag = extract(grandchild.tag)
-                handler = self._list_item_handlers.get(grandtag)
+                handler = self._list_item_handlers[grandchild.tag]
                 assert handler
-                output.append(handler(grandchild))
+                output.append(handler(self, grandchild))
                 assert not grandchild.tail
             assert not child.tail
         return "\n".join(output)
@@ -214,4 +257,22 @@ class TextVisitor():
     @staticmethod
     def _on_frame(paragraph, frame):
         paragraph.append(" IMAGE ")
-        
\ No newline at end of file
+    
+    # Dispatch tables
+    _text_child_handlers = Dispatcher({
+        "p": _on_p,
+        "h": _on_h,
+        "list": _on_list,
+        "table": _on_table
+    })
+    _paragraph_child_handlers = Dispatcher({
+        "a": _on_a,
+        "span": _on_span,
+        "frame": _on_frame,
+        "s": _on_s,
+        "tab": _on_tab
+    })
+    _list_item_handlers = Dispatcher({
+        "p": _on_p,
+        "list": _on_list,
+    })
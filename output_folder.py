@@ -0,0 +1,109 @@
+"Writing output files either into a new folder or into an existing one while touching only the files that changed"
+
+import io
+import os
+
+
+MANIFEST_FILE_NAME = ".odt2wiki-files"
+
+
+class OutputFolder:
+    def __init__(self, root, sync = False):
+        self._root = root
+        self._sync = sync
+        self._files = set()
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    def make_dir(self, path):
+        if self._sync:
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.mkdir(path)
+
+    def write_text(self, filename, text):
+        # Same as writing in text mode
+        if os.linesep != "\n":
+            text = text.replace("\n", os.linesep)
+        self.write_bytes(filename, text.encode("utf-8"))
+
+    # A text file to be written piece by piece. In the sync mode the text is collected and compared with the existing file when the stream is closed.
+    def open_text(self, filename):
+        if self._sync:
+            return _SyncedText(self, filename)
+        self._add_file(filename)
+        self.created += 1
+        return open(filename, "x", encoding="utf-8")
+
+    def write_bytes(self, filename, data):
+        self._add_file(filename)
+        if not self._sync:
+            mode = "xb"
+            self.created += 1
+        elif not os.path.exists(filename):
+            mode = "wb"
+            self.created += 1
+        elif self._is_same(filename, data):
+            self.unchanged += 1
+            return
+        else:
+            mode = "wb"
+            self.updated += 1
+        with open(filename, mode) as file:
+            file.write(data)
+
+    def _add_file(self, filename):
+        rel_filename = os.path.relpath(filename, self._root)
+        assert rel_filename not in self._files, rel_filename
+        self._files.add(rel_filename)
+
+    def finalize(self):
+        manifest = os.path.join(self._root, MANIFEST_FILE_NAME)
+        # Delete the files which were written by the previous run but not by this one
+        if self._sync and os.path.exists(manifest):
+            with open(manifest, encoding="utf-8") as file:
+                old_files = file.read().splitlines()
+            for f in old_files:
+                if f and f not in self._files:
+                    self._delete(f)
+        # Remember the files we have written, also without --sync for a later --sync run to be able to delete them
+        data = "".join([f + "\n" for f in sorted(self._files)]).encode("utf-8")
+        if not (self._sync and os.path.exists(manifest) and self._is_same(manifest, data)):
+            with open(manifest, "wb") as file:
+                file.write(data)
+        if not self._sync:
+            return
+        print(f"Output files created: {self.created}, updated: {self.updated}, unchanged: {self.unchanged}, deleted: {self.deleted}")
+
+    def _delete(self, rel_filename):
+        filename = os.path.join(self._root, rel_filename)
+        if not os.path.exists(filename):
+            return
+        os.remove(filename)
+        self.deleted += 1
+        # Remove folders left empty
+        folder = os.path.dirname(rel_filename)
+        while folder and not os.listdir(os.path.join(self._root, folder)):
+            os.rmdir(os.path.join(self._root, folder))
+            folder = os.path.dirname(folder)
+
+    @staticmethod
+    def _is_same(filename, data):
+        if os.path.getsize(filename) != len(data):
+            return False
+        with open(filename, "rb") as file:
+            return file.read() == data
+
+
+class _SyncedText(io.StringIO):
+    def __init__(self, folder, filename):
+        super().__init__()
+        self._folder = folder
+        self._filename = filename
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._folder.write_text(self._filename, self.getvalue())
+        return super().__exit__(exc_type, exc_value, traceback)
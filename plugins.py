@@ -127,6 +127,12 @@ class Customization:
     @staticmethod
     def is_useful_image(image):
         return False
+    
+    # Any state other than the code that affects rendered pages. Rendered pages are cached by it,
+    # thus it should be picklable and the same in every run for the same state (e.g. no sets).
+    @staticmethod
+    def get_render_signature():
+        return None
 
 
 # Analytics - it skips the root section (the autogenerated Table of Contents)
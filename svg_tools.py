@@ -64,6 +64,14 @@ def get_dimensions(content):
     assert height, height_match[1]
     return width, height
 
+# Same for the <svg> tag, None if any dimension is missing or is not in pixels
+def find_dimensions(tag):
+    width_match = re.search(r'\swidth="(\d+\.?\d*)(px)?"', tag, FLAGS)
+    height_match = re.search(r'\sheight="(\d+\.?\d*)(px)?"', tag, FLAGS)
+    if not width_match or not height_match:
+        return None
+    return int(float(width_match[1])), int(float(height_match[1]))
+
 def list_colors(content):
     matches = re.findall(COLOR_REGEXP, content, FLAGS)
     assert matches